@@ -0,0 +1,290 @@
+import argparse
+import datetime
+import json
+import platform
+import time
+
+import numpy as np
+import pandas as pd
+import ortools
+
+import schedule
+
+# sizes of the default sweep, as (professors, courses, time slots)
+DEFAULT_SIZES = ['10x20x40', '20x40x80', '40x80x150', '80x160x250']
+WEEKDAY_COLUMNS = ['Mon', 'Tue', 'Wed', 'Thur', 'Fri']
+# day patterns of the generated time slots
+DAY_PATTERNS = [[1, 0, 1, 0, 1], [0, 1, 0, 1, 0], [1, 0, 1, 0, 0], [1, 1, 1, 1, 1], [0, 1, 0, 0, 0]]
+
+
+# generate the five input tabs of a random department, in the format returned by read_excel
+# the same seed always gives the same instance. every course can be taught by at least one professor,
+# sections_per_course is the most sections of a course in a semester, each of them must be offered
+# with probability must_offer_ratio
+def generate_instance(professors=20, courses=40, slots=80, semesters=('Fall', 'Spring'), sections_per_course=2,
+                      lab_ratio=0.1, can_teach_density=0.3, preference_density=0.2, must_offer_ratio=0.3,
+                      seed=0):
+    rng = np.random.default_rng(seed)
+    professor_names = ['Prof {}'.format(i) for i in range(professors)]
+    course_names = ['Course {}'.format(i) for i in range(courses)]
+
+    can_teach = rng.random((professors, courses)) < can_teach_density
+    can_teach[rng.integers(0, professors, courses), np.arange(courses)] = True
+    prefers = can_teach & (rng.random((professors, courses)) < preference_density / can_teach_density)
+    can_teach_tab = pd.DataFrame(can_teach.astype(int), index=professor_names, columns=course_names)
+    prefer_tab = pd.DataFrame(prefers.astype(int), index=professor_names, columns=course_names)
+
+    labs = (rng.random(courses) < lab_ratio).astype(int)
+    course_tab = pd.DataFrame({'Unit': rng.choice([4, 4, 4, 2], courses), 'Lab': labs}, index=course_names)
+    for semester in semesters:
+        num_sections = rng.integers(0, sections_per_course + 1, courses)
+        course_tab[semester] = num_sections
+        course_tab[semester + '_MustOffer'] = rng.binomial(num_sections, must_offer_ratio)
+
+    prof_tab = pd.DataFrame({'MaxUnit': rng.choice([16, 20, 24], professors)}, index=professor_names)
+    for days in schedule.Time.Days_of_week:
+        preferred = [','.join(frames) if frames else None
+                     for frames in ([frame for frame in schedule.TIMEFRAME if rng.random() < 0.4]
+                                    for _ in range(professors))]
+        prof_tab[days] = preferred
+
+    # lab slots are three hours long, the others one hour, starting on the quarter hour from 8:00 to 18:45
+    slot_labs = rng.random(slots) < max(lab_ratio, 1.0 / slots)
+    slot_labs[0] = True
+    slot_labs[-1] = False
+    starts = rng.integers(8 * 4, 19 * 4, slots) * 15
+    lengths = np.where(slot_labs, 175, 55)
+    patterns = np.array(DAY_PATTERNS)[rng.integers(0, len(DAY_PATTERNS), slots)]
+    time_tab = pd.DataFrame(patterns, columns=WEEKDAY_COLUMNS)
+    time_tab['START TIME'] = ['{:02d}:{:02d}:00'.format(start // 60, start % 60) for start in starts]
+    time_tab['END TIME'] = ['{:02d}:{:02d}:00'.format((start + length) // 60, (start + length) % 60)
+                            for start, length in zip(starts, lengths)]
+    time_tab['Lab'] = slot_labs.astype(int)
+    return [can_teach_tab, prefer_tab, course_tab, prof_tab, time_tab]
+
+
+# write generated tabs to an excel workbook that schedule.py can read
+def write_instance(sheets, file_name):
+    with pd.ExcelWriter(file_name) as writer:
+        for name, tab in zip(schedule.SHEET_NAMES, sheets):
+            tab.to_excel(writer, sheet_name=name, index=name != 'Time')
+
+
+# run the pipeline steps on one instance and return their measurements
+# every solve gets time_limit seconds, the optimal assignments are enumerated up to max_solutions
+# when the assignment is proven optimal. an instance rejected by the feasibility checks or without
+# an assignment only has the measurements up to there, with the reason as its 'infeasible' entry,
+# or its 'no_solution' entry when the assignment solve stopped without a solution
+def run_instance(sheets, time_limit=30, max_solutions=100, workers=0):
+    settings = schedule.SolverSettings(time_limit, workers, random_seed=0)
+    result = {}
+
+    start = time.perf_counter()
+    try:
+        semesters, sections, professors, times = schedule.read_input(sheets)
+    except ValueError as error:
+        result['read_input'] = {'seconds': time.perf_counter() - start}
+        result['infeasible'] = str(error)
+        result['peak_memory_mb'] = schedule.peak_memory_mb()
+        return result
+    conflict_index = schedule.ConflictIndex(times)
+    result['read_input'] = {'seconds': time.perf_counter() - start, 'professors': len(professors),
+                            'sections': len(sections), 'slots': len(times),
+                            'conflicts': conflict_index.num_conflicts()}
+
+    start = time.perf_counter()
+    model, classes = schedule.create_model(professors, sections, semesters)
+    result['create_model'] = dict(seconds=time.perf_counter() - start, **schedule.model_statistics(model))
+
+    start = time.perf_counter()
+    try:
+        solver = schedule.solve_model(model, settings)
+    except schedule.InfeasibleError as error:
+        result['solve_model'] = {'seconds': time.perf_counter() - start, 'status': 'INFEASIBLE'}
+        result['infeasible'] = str(error)
+        result['peak_memory_mb'] = schedule.peak_memory_mb()
+        return result
+    except schedule.NoSolutionError as error:
+        result['solve_model'] = {'seconds': time.perf_counter() - start, 'status': error.status}
+        result['no_solution'] = str(error)
+        result['peak_memory_mb'] = schedule.peak_memory_mb()
+        return result
+    result['solve_model'] = dict(seconds=time.perf_counter() - start,
+                                 **schedule.search_statistics(model, solver))
+
+    scheduled_classes = schedule.get_semester_schedule(solver, classes, professors, sections, semesters)
+    result['create_timetable_model'] = []
+    result['solve_timetable'] = []
+    timetables = {}
+    for semester in semesters:
+        start = time.perf_counter()
+        timetable_model, time_assign = schedule.create_timetable_model(
+            scheduled_classes[semester], professors, sections, times, conflict_index=conflict_index)
+        result['create_timetable_model'].append(dict(semester=semester, seconds=time.perf_counter() - start,
+                                                     **schedule.model_statistics(timetable_model)))
+        start = time.perf_counter()
+        try:
+            timetable_solver = schedule.solve_model(timetable_model, settings)
+            statistics = schedule.search_statistics(timetable_model, timetable_solver)
+            timetables[semester] = schedule.get_semester_timetable(timetable_solver, time_assign,
+                                                                   scheduled_classes[semester], times)
+        except schedule.InfeasibleError:
+            statistics = {'status': 'INFEASIBLE'}
+        except schedule.NoSolutionError as error:
+            statistics = {'status': error.status}
+        result['solve_timetable'].append(dict(semester=semester, seconds=time.perf_counter() - start,
+                                              **statistics))
+    requests_met, preferred_times, conflicts, num_classes = schedule.evaluate_schedule(
+        professors, sections, times, scheduled_classes, timetables, conflict_index)
+    result['schedule'] = {'requests_met': requests_met, 'preferred_times': preferred_times,
+                          'conflicts': conflicts, 'classes': num_classes}
+
+    if result['solve_model']['status'] == 'OPTIMAL' and max_solutions:
+        start = time.perf_counter()
+        solutions = schedule.find_all_schedule(model, classes, max_solutions, time_limit)
+        result['find_all_schedule'] = {'seconds': time.perf_counter() - start, 'solutions': len(solutions)}
+    result['peak_memory_mb'] = schedule.peak_memory_mb()
+    return result
+
+
+# run_instance with its total time
+def measure_instance(sheets, time_limit=30, max_solutions=100, workers=0):
+    start = time.perf_counter()
+    measurements = run_instance(sheets, time_limit, max_solutions, workers)
+    measurements['total_seconds'] = time.perf_counter() - start
+    return measurements
+
+
+# run the benchmark for every size, return the results file content
+def run_benchmark(sizes, seed=0, time_limit=30, max_solutions=100, workers=0, **generator_options):
+    results = []
+    for size in sizes:
+        professors, courses, slots = (int(n) for n in size.split('x'))
+        sheets = generate_instance(professors, courses, slots, seed=seed, **generator_options)
+        # each instance runs in a new process, so its peak memory isn't that of the larger instances before it
+        with schedule.process_pool(1) as executor:
+            measurements = executor.submit(measure_instance, sheets, time_limit, max_solutions, workers).result()
+        results.append({'size': size, 'measurements': measurements})
+        print_result(size, measurements)
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'ortools': ortools.__version__,
+        'seed': seed,
+        'time_limit': time_limit,
+        'generator': generator_options,
+        'results': results,
+    }
+
+
+# the main numbers of a run of one instance, used for printing and comparing
+# the steps an infeasible instance didn't reach are None
+def summary(measurements):
+    timetable_models = measurements.get('create_timetable_model')
+    schedule_counts = measurements.get('schedule', {})
+    variables = measurements.get('create_model', {}).get('variables')
+    if variables is not None and timetable_models is not None:
+        variables += sum(m['variables'] for m in timetable_models)
+    return {
+        'read_input s': measurements.get('read_input', {}).get('seconds'),
+        'create_model s': measurements.get('create_model', {}).get('seconds'),
+        'solve_model s': measurements.get('solve_model', {}).get('seconds'),
+        'timetable build s': None if timetable_models is None else sum(m['seconds'] for m in timetable_models),
+        'timetable solve s': None if timetable_models is None
+        else sum(m['seconds'] for m in measurements['solve_timetable']),
+        'find_all s': measurements.get('find_all_schedule', {}).get('seconds'),
+        'total s': measurements.get('total_seconds'),
+        'variables': variables,
+        'requests met': schedule_counts.get('requests_met'),
+        'preferred times': schedule_counts.get('preferred_times'),
+        'conflicts': schedule_counts.get('conflicts'),
+        'classes': schedule_counts.get('classes'),
+        'peak MB': measurements['peak_memory_mb'],
+    }
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float) and not value.is_integer():
+        return '{:.3f}'.format(value)
+    return '{:d}'.format(int(value))
+
+
+def print_result(size, measurements):
+    print(size)
+    if 'infeasible' in measurements:
+        print('  infeasible: {}'.format(measurements['infeasible']))
+    if 'no_solution' in measurements:
+        print('  {}'.format(measurements['no_solution']))
+    for name, value in summary(measurements).items():
+        print('  {:<20} {:>14}'.format(name, format_value(value)))
+    print()
+
+
+# print the results of two benchmark files side by side for the sizes they share,
+# with the ratio new / old for the timings
+def compare_results(old_file, new_file):
+    with open(old_file) as f:
+        old = {result['size']: result['measurements'] for result in json.load(f)['results']}
+    with open(new_file) as f:
+        new = {result['size']: result['measurements'] for result in json.load(f)['results']}
+    for size in [size for size in new if size in old]:
+        print(size)
+        print('  {:<20} {:>14} {:>14} {:>8}'.format('', 'old', 'new', 'ratio'))
+        old_summary, new_summary = summary(old[size]), summary(new[size])
+        for name, new_value in new_summary.items():
+            old_value = old_summary[name]
+            ratio = ''
+            if name.endswith(' s') and old_value and new_value is not None:
+                ratio = '{:.2f}x'.format(new_value / old_value)
+            print('  {:<20} {:>14} {:>14} {:>8}'.format(name, format_value(old_value), format_value(new_value),
+                                                         ratio))
+        print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the scheduling pipeline on synthetic departments.')
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES,
+                        help='instance sizes as PROFESSORSxCOURSESxSLOTS (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the instance generator')
+    parser.add_argument('--semesters', nargs='+', default=['Fall', 'Spring'], help='semester names')
+    parser.add_argument('--sections-per-course', type=int, default=2,
+                        help='most sections of a course in a semester')
+    parser.add_argument('--lab-ratio', type=float, default=0.1, help='fraction of lab courses and lab slots')
+    parser.add_argument('--can-teach-density', type=float, default=0.3,
+                        help='fraction of the courses a professor can teach')
+    parser.add_argument('--preference-density', type=float, default=0.2,
+                        help='fraction of the courses a professor requests')
+    parser.add_argument('--must-offer-ratio', type=float, default=0.3,
+                        help='probability that a section must be offered')
+    parser.add_argument('--time-limit', type=float, default=30, help='time limit in seconds for each solve')
+    parser.add_argument('--max-solutions', type=int, default=100,
+                        help='most optimal assignments to enumerate, 0 to skip find_all_schedule')
+    parser.add_argument('--workers', type=int, default=0, help='number of CP-SAT search workers')
+    parser.add_argument('--output', default='benchmark_results.json', help='json file for the results')
+    parser.add_argument('--write-instance', metavar='FILE',
+                        help='write the instance of the first size to an excel file and exit')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+    else:
+        options = {
+            'semesters': args.semesters,
+            'sections_per_course': args.sections_per_course,
+            'lab_ratio': args.lab_ratio,
+            'can_teach_density': args.can_teach_density,
+            'preference_density': args.preference_density,
+            'must_offer_ratio': args.must_offer_ratio,
+        }
+        if args.write_instance:
+            professors, courses, slots = (int(n) for n in args.sizes[0].split('x'))
+            write_instance(generate_instance(professors, courses, slots, seed=args.seed, **options),
+                           args.write_instance)
+        else:
+            report = run_benchmark(args.sizes, args.seed, args.time_limit, args.max_solutions, args.workers,
+                                   **options)
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=1)
@@ -1,17 +1,51 @@
 from ortools.sat.python import cp_model
 import pandas as pd
+import numpy as np
 import datetime
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import sys
+import time
 import copy
+import argparse
+import json
+import os
+import concurrent.futures
+import multiprocessing
+import random
+import hashlib
+import io
+import pickle
+import contextlib
+import cProfile
+import threading
 
 SHEETS_URL = "https://docs.google.com/spreadsheets/d/112IxSjwhCQmKnJdwn_UebT_lEW5CR2Q3GMzeaFJuNBg/edit?usp=sharing"
 EXCEL_NAME = 'Testing data.xlsx'
 MAX_UNITS_PER_SEMESTER = 12
 TIMEFRAME = ['Morning', 'Afternoon', 'Evening']
+SHEET_NAMES = ['CanTeach', 'Prefer', 'Course', 'Prof', 'Time']
+# directory of the cache of parsed input tabs
+CACHE_DIR = '.schedule_cache'
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files/'
+# tab and columns of the exported schedule
+SCHEDULE_SHEET = 'Schedule'
+SCHEDULE_COLUMNS = ['Semester', 'Professor', 'Section', 'Course', 'Unit', 'Requested', 'Days', 'START TIME',
+                    'END TIME', 'Lab', 'Preferred time']
+# file extensions of the schedule exports
+EXPORT_FORMATS = ('.csv', '.json', '.xlsx')
+# weights of the joint assignment and timetable objective
+REQUEST_WEIGHT = 4
+PREFERRED_TIME_WEIGHT = 2
+CONFLICT_WEIGHT = 1
+# defaults of the LNS timetable engine: total seconds per semester, classes freed per step,
+# seconds per step and rounds in a row without improvement before stopping
+LNS_TIME_LIMIT = 60
+LNS_NEIGHBORHOOD_SIZE = 30
+LNS_NEIGHBORHOOD_TIME_LIMIT = 1.0
+LNS_PATIENCE = 50
 
 
 class Time:
+    __slots__ = ('start', 'end', 'weekdays', 'lab', 'days_of_week', 'timeframe')
     Days_of_week = {'MWF': [1, 0, 1, 0, 1],
                     'TR': [0, 1, 0, 1, 0],
                     'MW': [1, 0, 1, 0, 0],
@@ -22,12 +56,16 @@ class Time:
                     'W': [0, 0, 1, 0, 0],
                     'R': [0, 0, 0, 1, 0]}
 
+    # start and end are datetime.time or strings like 14:05:00
     def __init__(self, start, end, weekdays, lab):
-        self.start = datetime.datetime.strptime(start, '%H:%M:%S').time()
-        self.end = datetime.datetime.strptime(end, '%H:%M:%S').time()
+        if isinstance(start, str):
+            start = datetime.datetime.strptime(start, '%H:%M:%S').time()
+        if isinstance(end, str):
+            end = datetime.datetime.strptime(end, '%H:%M:%S').time()
+        self.start = start
+        self.end = end
         self.weekdays = weekdays
         self.lab = lab
-        self.conflicts = ()
         WEEKDAYS = 'MTWRF'
         self.days_of_week = ''.join(day_str for day_str, day_bool in zip(WEEKDAYS, weekdays) if day_bool)
         self.timeframe = 'Evening'
@@ -41,6 +79,10 @@ class Time:
         print('end:', self.end)
         print('weekdays:', self.weekdays)
 
+    # identify the time slot by its days and times, used to save schedules
+    def key(self):
+        return '{} {}-{} lab {}'.format(self.days_of_week, self.start, self.end, int(self.lab))
+
     # check if conflicts with a time
     # return true if there is a conflict
     def conflict(self, time):
@@ -57,23 +99,82 @@ class Time:
         return False
 
 
+# conflicts between time slots, computed once per run and used by the model builders
+# slots are stored by their position in the times list, as minute ranges and weekday bitmasks
+class ConflictIndex:
+
+    def __init__(self, times):
+        self.starts = [t.start.hour * 60 + t.start.minute for t in times]
+        self.ends = [t.end.hour * 60 + t.end.minute for t in times]
+        self.days = [sum(1 << day for day, on in enumerate(t.weekdays) if on) for t in times]
+        self.neighbors = [[] for _ in times]  # ids of the conflicting slots, including the slot itself
+        self.bits = [0] * len(times)  # the same conflicts as bitsets
+
+        # sweep over the slots by start time, keeping the slots that haven't ended yet,
+        # a slot conflicts with the active slots sharing one of its days
+        active = []
+        for i in sorted(range(len(times)), key=lambda i: self.starts[i]):
+            active = [j for j in active if self.ends[j] >= self.starts[i]]
+            for j in active:
+                if self.days[i] & self.days[j]:
+                    self.add(i, j)
+            if self.days[i]:
+                self.add(i, i)
+            active.append(i)
+        for neighbors in self.neighbors:
+            neighbors.sort()
+        self.cliques = self.find_cliques()
+
+    def add(self, i, j):
+        self.bits[i] |= 1 << j
+        self.neighbors[i].append(j)
+        if i != j:
+            self.bits[j] |= 1 << i
+            self.neighbors[j].append(i)
+
+    # return true if the time slots with ids i and j conflict
+    def conflict(self, i, j):
+        return bool(self.bits[i] >> j & 1)
+
+    # groups of slots that all conflict with each other, every conflicting pair is in at least one group.
+    # two slots conflict when they share a day and one starts while the other is running,
+    # so on each day the slots running at each start time form a group.
+    # keep the groups that aren't contained in the group at the next start time
+    def find_cliques(self):
+        cliques = set()
+        for day in range(5):
+            on_day = [i for i in range(len(self.starts)) if self.days[i] >> day & 1]
+            points = sorted(set(self.starts[i] for i in on_day))
+            for point, next_point in zip(points, points[1:] + [None]):
+                running = [i for i in on_day if self.starts[i] <= point <= self.ends[i]]
+                # the group is contained in the next one if none of its slots end before the next start
+                if next_point is not None and min(self.ends[i] for i in running) >= next_point:
+                    continue
+                cliques.add(tuple(running))
+        return sorted(cliques)
+
+    # number of ordered pairs of conflicting slots
+    def num_conflicts(self):
+        return sum(len(neighbors) for neighbors in self.neighbors)
+
+
+# sections and professors have integer ids, used as keys of the model variables
 class Section:
+    __slots__ = ('id', 'course', 'section', 'units', 'semester', 'must_offer', 'lab', 'name')
 
-    def __init__(self, course, section, units, semester, must_offer, lab):
+    def __init__(self, course, section, units, semester, must_offer, lab, id=0):
+        self.id = id
         self.course = course
         self.section = section
         self.units = units
         self.semester = semester
         self.must_offer = must_offer
         self.lab = lab
+        self.name = sys.intern(semester + ' ' + course + ' Section ' + str(section))
 
     def __str__(self):
         return self.name
 
-    @property
-    def name(self):
-        return self.semester + ' ' + self.course + ' Section ' + str(self.section)
-
     def info(self):
         print('course:', self.course)
         print('section:', self.section)
@@ -82,8 +183,10 @@ class Section:
 
 
 class Professor:
+    __slots__ = ('id', 'name', 'max_units', 'capabilities', 'preference', 'prefer_timeframe')
 
-    def __init__(self, name, max_units, capabilities, preference, prefer_timeframe):
+    def __init__(self, name, max_units, capabilities, preference, prefer_timeframe, id=0):
+        self.id = id
         self.name = name
         self.max_units = max_units
         self.capabilities = capabilities
@@ -121,38 +224,175 @@ class Professor:
 
 # get data from google spreadsheet
 # given the sheets name and the certificate file in directory
-def read_ggsheets(sheets_url):
-    # use creds to create a client to interact with the Google Drive API
-    scopes = [
-        'https://www.googleapis.com/auth/spreadsheets',
-        'https://www.googleapis.com/auth/drive'
-    ]
-    creds = ServiceAccountCredentials.from_json_keyfile_name('client_secret.json', scopes)
-    client = gspread.authorize(creds)
+# the google api packages are imported when they are used, they are slow to import
+def open_spreadsheet(sheets_url, client=None):
+    if client is None:
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
+        # use creds to create a client to interact with the Google Drive API
+        scopes = [
+            'https://www.googleapis.com/auth/spreadsheets',
+            'https://www.googleapis.com/auth/drive'
+        ]
+        creds = ServiceAccountCredentials.from_json_keyfile_name('client_secret.json', scopes)
+        client = gspread.authorize(creds)
     # Open the sheets
-    sheets = client.open_by_url(sheets_url)
-
-    can_teach_tab = pd.DataFrame(sheets.worksheet('CanTeach').get_all_records()).set_index('')
-    prefer_tab = pd.DataFrame(sheets.worksheet('Prefer').get_all_records()).set_index('')
-    course_tab = pd.DataFrame(sheets.worksheet('Course').get_all_records()).set_index('')
-    prof_tab = pd.DataFrame(sheets.worksheet('Prof').get_all_records()).set_index('')
-    time_tab = pd.DataFrame(sheets.worksheet('Time').get_all_records())
-    sheets = [can_teach_tab, prefer_tab, course_tab, prof_tab, time_tab]
+    return client.open_by_url(sheets_url)
+
+
+def read_ggsheets(sheets_url, client=None, cache_dir=CACHE_DIR):
+    spreadsheet = open_spreadsheet(sheets_url, client)
+
+    # the parsed tabs are cached until the spreadsheet is modified
+    key = sheets_cache_key(spreadsheet)
+    sheets = load_cached_sheets(cache_dir, key)
+    if sheets is None:
+        # get all the tabs in one request
+        ranges = ["'{}'".format(name) for name in SHEET_NAMES]
+        value_ranges = spreadsheet.values_batch_get(ranges)['valueRanges']
+        sheets = [records_frame(value_range.get('values', []), name != 'Time')
+                  for name, value_range in zip(SHEET_NAMES, value_ranges)]
+        store_cached_sheets(cache_dir, key, sheets)
     return sheets
 
 
+# cache key of a spreadsheet's tabs, changes when it is modified
+# the sheets api doesn't report the modification time, it is read from the drive api
+def sheets_cache_key(spreadsheet):
+    response = spreadsheet.client.request('get', DRIVE_FILES_URL + spreadsheet.id,
+                                          params={'fields': 'modifiedTime', 'supportsAllDrives': True})
+    return 'sheets {} {}'.format(spreadsheet.id, response.json()['modifiedTime'])
+
+
+# frame of a tab from its values, like the records of get_all_records:
+# the first row is the header and numbers are converted
+# index: the first column (with an empty header) is the index
+def records_frame(values, index):
+    import gspread.utils
+    header = values[0] if values else []
+    rows = [gspread.utils.numericise_all((row + [''] * len(header))[:len(header)]) for row in values[1:]]
+    frame = pd.DataFrame(rows, columns=header)
+    if index:
+        frame = frame.set_index('')
+    return frame
+
+
+# offline stand-in for the gspread client, serves the tabs of an excel file the way google sheets does
+# read_ggsheets('Testing data.xlsx', LocalSheetsClient()) reads the file like a spreadsheet
+# written values are kept in memory in the written dict of the spreadsheet, the file isn't changed
+class LocalSheetsClient:
+
+    def open_by_url(self, url):
+        return LocalSpreadsheet(url, self)
+
+    # only answers the drive api request of sheets_cache_key, the id of a local spreadsheet is its path
+    def request(self, method, endpoint, params=None):
+        file_name = endpoint[len(DRIVE_FILES_URL):]
+        return LocalResponse({'modifiedTime': datetime.datetime.fromtimestamp(os.path.getmtime(file_name)).isoformat()})
+
+
+class LocalResponse:
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class LocalSpreadsheet:
+
+    def __init__(self, file_name, client):
+        self.file_name = file_name
+        self.client = client
+        self.id = os.path.abspath(file_name)
+        self.written = {}  # tab name : values
+
+    def values_batch_get(self, ranges, params=None):
+        value_ranges = []
+        with pd.ExcelFile(self.file_name) as workbook:
+            for sheet_range in ranges:
+                frame = workbook.parse(sheet_range.strip("'"), header=None, dtype=object)
+                values = [[formatted_value(value) for value in row] for row in frame.itertuples(index=False)]
+                value_ranges.append({'range': sheet_range, 'values': values})
+        return {'valueRanges': value_ranges}
+
+    def worksheets(self):
+        with pd.ExcelFile(self.file_name) as workbook:
+            names = workbook.sheet_names
+        return [LocalWorksheet(name) for name in names + [name for name in self.written if name not in names]]
+
+    def add_worksheet(self, title, rows, cols):
+        self.written[title] = []
+        return LocalWorksheet(title)
+
+    def values_clear(self, sheet_range):
+        self.written[sheet_range.strip("'")] = []
+
+    # each range is written from the first cell of its tab
+    def values_batch_update(self, params=None, body=None):
+        for value_range in body['data']:
+            self.written[value_range['range'].split('!')[0].strip("'")] = value_range['values']
+
+
+class LocalWorksheet:
+
+    def __init__(self, title):
+        self.title = title
+
+
+# cell value as google sheets formats it
+def formatted_value(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.time):
+        return value.strftime('%H:%M:%S')
+    return str(value)
+
+
 # get data from excel
 # given the excel name
-def read_excel(input_file):
-    can_teach_tab = pd.read_excel(input_file, sheet_name='CanTeach', index_col=0)
-    prefer_tab = pd.read_excel(input_file, sheet_name='Prefer', index_col=0)
-    course_tab = pd.read_excel(input_file, sheet_name='Course', index_col=0)
-    prof_tab = pd.read_excel(input_file, sheet_name='Prof', index_col=0)
-    time_tab = pd.read_excel(input_file, sheet_name='Time', index_col=None)
-    sheets = [can_teach_tab, prefer_tab, course_tab, prof_tab, time_tab]
+# the workbook is read once and the parsed tabs are cached by the hash of its content
+def read_excel(input_file, cache_dir=CACHE_DIR):
+    with open(input_file, 'rb') as f:
+        data = f.read()
+    key = 'excel ' + hashlib.sha256(data).hexdigest()
+    sheets = load_cached_sheets(cache_dir, key)
+    if sheets is None:
+        with pd.ExcelFile(io.BytesIO(data)) as workbook:
+            sheets = [workbook.parse(name, index_col=None if name == 'Time' else 0) for name in SHEET_NAMES]
+        store_cached_sheets(cache_dir, key, sheets)
     return sheets
 
 
+# the cache has one pickle file of the parsed tabs per key, no cache if cache_dir is None
+def cached_sheets_path(cache_dir, key):
+    return os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + '.pickle')
+
+
+def load_cached_sheets(cache_dir, key):
+    if cache_dir is None:
+        return None
+    path = cached_sheets_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def store_cached_sheets(cache_dir, key, sheets):
+    if cache_dir is None:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cached_sheets_path(cache_dir, key)
+    # write to a temporary file first so that an interrupted run doesn't leave a broken cache
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(sheets, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
 # read input, separate classes into sections
 # check for infeasible situation, and store info into objects
 def read_input(sheets):
@@ -168,78 +408,73 @@ def read_input(sheets):
     assert courses_okay, 'some courses are missing from some tabs!'
 
     # get course names, prof names, and semester names
-    course_names = set(can_teach_tab.columns)
-    professor_names = set(can_teach_tab.index)
-    semesters = course_tab.columns.tolist()
-    semesters.remove('Unit')
-    semesters.remove('Lab')
+    # keep the order of the CanTeach tab and align the other tabs to it
+    course_names = can_teach_tab.columns.tolist()
+    professor_names = can_teach_tab.index.tolist()
+    semesters = [s for s in course_tab.columns if s not in ('Unit', 'Lab') and 'MustOffer' not in s]
     for s in semesters:
-        if "MustOffer" in s:
-            semesters.remove(s)
         # check that all semesters have a MustOffer tab
-        elif s + "_MustOffer" not in course_tab.columns.tolist():
+        if s + "_MustOffer" not in course_tab.columns:
             raise ValueError(s, 'semester does not have its corresponding MustOffer tab')
 
+    # boolean matrices of professors x courses
+    can_teach = can_teach_tab.loc[professor_names, course_names].to_numpy() == 1
+    prefers = prefer_tab.loc[professor_names, course_names].to_numpy() == 1
+    course_array = np.array(course_names, dtype=object)
+    max_units = prof_tab.loc[professor_names, 'MaxUnit'].to_numpy()
+
     # create Professor objects for each prof
     professors = {}  # {prof name : Professor}
-    for name in professor_names:
-        max_units = prof_tab['MaxUnit'][name]
-        capabilities = set(
-            course_name for course_name in course_names
-            if can_teach_tab[course_name][name] == 1
-        )
-        preferences = set(
-            course_name for course_name in course_names
-            if prefer_tab[course_name][name] == 1
-        )
-        days_of_week = {}
-        for days in Time.Days_of_week:
-            if prof_tab[days][name] is not None:
-                days_of_week[days] = str(prof_tab[days][name]).split(",")
-
-        professors[name] = Professor(name, max_units, capabilities, preferences, days_of_week)
+    prefer_timeframes = {name: {} for name in professor_names}
+    for days in Time.Days_of_week:
+        for name, value in prof_tab.loc[professor_names, days].items():
+            if value is not None:
+                prefer_timeframes[name][days] = str(value).split(",")
+    for i, name in enumerate(professor_names):
+        capabilities = set(course_array[can_teach[i]])
+        preferences = set(course_array[prefers[i]])
+        professors[name] = Professor(name, max_units[i].item(), capabilities, preferences, prefer_timeframes[name],
+                                     id=i)
 
     # create Section objects for each section
+    # arrays of courses x semesters for the number of sections
+    course_tab = course_tab.loc[course_names]
+    units = course_tab['Unit'].to_numpy()
+    labs = course_tab['Lab'].to_numpy()
+    num_sections = course_tab[semesters].to_numpy()
+    must_offer = course_tab[[s + '_MustOffer' for s in semesters]].to_numpy()
     sections = {}  # {section name : Section}
-    for course_name in course_names:
-        units = course_tab['Unit'][course_name]
-        lab = course_tab['Lab'][course_name]
-        for semester in semesters:
-            num_sections = course_tab[semester][course_name]
-            must_offer = course_tab[semester + '_MustOffer'][course_name]
-            section_num = 0
-            for must in range(must_offer):
-                section = Section(course_name, section_num, units, semester, must_offer=1, lab=lab)
+    for i, course_name in enumerate(course_names):
+        for j, semester in enumerate(semesters):
+            for section_num in range(num_sections[i, j]):
+                section = Section(course_name, section_num, units[i].item(), semester,
+                                  must_offer=int(section_num < must_offer[i, j]), lab=labs[i].item(),
+                                  id=len(sections))
                 sections[section.name] = section
-                section_num = section_num + 1
-            for optional in range(num_sections - must_offer):
-                section = Section(course_name, section_num, units, semester, must_offer=0, lab=lab)
-                sections[section.name] = section
-                section_num = section_num + 1
 
     # create Time objects for each time slots
-    # Time have start time, end time, list of 1/0 for weekdays, and a set of conflicted time slots
-    times = []
-    for _, rows in time_tab.iterrows():
-        info = rows.tolist()
-        times.append(Time(start=info[5], end=info[6], weekdays=info[0:5], lab=info[7]))
-    for t1 in times:
-        conflicts = set(t2 for t2 in times if t1.conflict(t2))
-        t1.conflicts = conflicts
+    # Time have start time, end time, list of 1/0 for weekdays
+    # conflicts between them are in the ConflictIndex
+    starts = pd.to_datetime(time_tab.iloc[:, 5].astype(str), format='%H:%M:%S').dt.time
+    ends = pd.to_datetime(time_tab.iloc[:, 6].astype(str), format='%H:%M:%S').dt.time
+    weekdays = time_tab.iloc[:, 0:5].to_numpy().tolist()
+    time_labs = time_tab.iloc[:, 7].to_numpy().tolist()
+    times = [Time(start=start, end=end, weekdays=days, lab=lab)
+             for start, end, days, lab in zip(starts, ends, weekdays, time_labs)]
 
     # error checking
 
     # for professors, it's better to not have all zeros for time slots preference
 
     # check that every course has at least one professor who can teach it
-    for course_name in course_names:
-        if not any(course_name in professor.capabilities for professor in professors.values()):
-            raise ValueError('No professor can teach ' + course_name)
+    untaught = course_array[~can_teach.any(axis=0)]
+    if len(untaught):
+        raise ValueError('No professor can teach ' + untaught[0])
 
     # check if the required units are more than professors' total units
-    total_professor_units = sum(professor.max_units for professor in professors.values())
-    course_units_required = sum(section.units for section in sections.values() if section.must_offer)
-    course_units_optional = sum(section.units for section in sections.values() if not section.must_offer)
+    total_professor_units = max_units.sum().item()
+    course_units_required = (units @ must_offer.sum(axis=1)).item()
+    course_units_optional = (units @ (num_sections - must_offer).sum(axis=1)).item()
     total_course_units = course_units_required + course_units_optional
     if course_units_required > total_professor_units:
         raise ValueError(course_units_required, 'are required, but professors can only teach',
@@ -249,90 +484,580 @@ def read_input(sheets):
     print('There are', total_course_units, 'units form all classes.')
     print(course_units_required, 'are required,', course_units_optional, 'are optional.')
 
+    # check that the must offer sections can be assigned and given a time slot
+    with profile_phase('feasibility check'):
+        check_feasibility(professors, sections, semesters, times)
+
     return semesters, sections, professors, times
 
 
+# quick checks for must offer sections that can't be scheduled, before building the models
+# raise a ValueError listing the problems
+def check_feasibility(professors, sections, semesters, times, max_units_per_semester=MAX_UNITS_PER_SEMESTER):
+    problems = []
+
+    # group the must offer sections by course and semester : [units of a section, number of sections]
+    required = {}
+    for section in sections.values():
+        if section.must_offer:
+            key = (section.course, section.semester)
+            if key not in required:
+                required[key] = [section.units, 0]
+            required[key][1] += 1
+
+    # every professor can teach at most MaxUnit units, and max_units_per_semester units in a semester.
+    # the required units must fit in a max flow from the professors, through the semesters they teach,
+    # to the courses they can teach in that semester. sections aren't split between professors,
+    # so it can pass for some infeasible inputs, but it never rejects a feasible one
+    from ortools.graph.python import max_flow
+    flow = max_flow.SimpleMaxFlow()
+    source, sink = 0, 1
+    course_nodes = {key: 2 + i for i, key in enumerate(required)}
+    next_node = 2 + len(course_nodes)
+    course_teachers = {key: [] for key in required}
+    for professor in professors.values():
+        professor_node = next_node
+        next_node += 1
+        flow.add_arc_with_capacity(source, professor_node, professor.max_units)
+        for semester in semesters:
+            semester_node = next_node
+            next_node += 1
+            flow.add_arc_with_capacity(professor_node, semester_node, max_units_per_semester)
+            for (course, course_semester), (units, count) in required.items():
+                if course_semester != semester or not professor.can_teach(course):
+                    continue
+                # a professor can only teach a section if it fits in both limits
+                if units > min(professor.max_units, max_units_per_semester):
+                    continue
+                flow.add_arc_with_capacity(semester_node, course_nodes[(course, semester)], units * count)
+                course_teachers[(course, semester)].append(professor.name)
+    demand = 0
+    for key, (units, count) in required.items():
+        flow.add_arc_with_capacity(course_nodes[key], sink, units * count)
+        demand += units * count
+
+    flow.solve(source, sink)
+    if flow.optimal_flow() < demand:
+        # the courses on the sink side of the min cut are the ones that can't all be covered
+        source_side = set(flow.get_source_side_min_cut())
+        short = [key for key, node in course_nodes.items() if node not in source_side]
+        missing = demand - flow.optimal_flow()
+
+        def names(keys):
+            return ', '.join(semester + ' ' + course for course, semester in sorted(keys, key=lambda k: (k[1], k[0])))
+
+        # courses nobody can teach get no units at all
+        unqualified = [key for key in short if not course_teachers[key]]
+        if unqualified:
+            problems.append('no professor can teach the must offer sections of {} within MaxUnit and {} units '
+                            'per semester'.format(names(unqualified), max_units_per_semester))
+            missing -= sum(required[key][0] * required[key][1] for key in unqualified)
+        short = [key for key in short if course_teachers[key]]
+        if short and missing:
+            short_demand = sum(required[key][0] * required[key][1] for key in short)
+            teachers = sorted(set(name for key in short for name in course_teachers[key]))
+            problems.append('must offer sections of {} need {} units, but {} can only teach {} of them'.format(
+                names(short), short_demand, ', '.join(teachers), short_demand - missing))
+
+    # lab sections are only given lab time slots, and other sections non-lab time slots
+    lab_slots = sum(1 for t in times if t.lab)
+    for (course, semester), (units, count) in required.items():
+        lab = next(section.lab for section in sections.values() if section.course == course)
+        if lab and not lab_slots:
+            problems.append('{} {} is a lab course but there are no lab time slots'.format(semester, course))
+        if not lab and lab_slots == len(times):
+            problems.append('{} {} is not a lab course but all time slots are lab'.format(semester, course))
+
+    if problems:
+        raise ValueError('PROBLEM IS INFEASIBLE: ' + '; '.join(problems))
+
+
 # create model and add constraints
-def create_model(professors, sections, semesters):
+# previous is a set of (professor id, section id) from an earlier schedule, used as solution hints
+# with minimal_change, among the schedules meeting the most requests pick the closest one to previous
+# symmetry_breaking orders the professors of interchangeable sections, see add_section_symmetry_breaking
+# with an assumptions dict, the hard constraints are enforced by assumption literals, see assumption_literal
+def create_model(professors, sections, semesters, previous=None, minimal_change=False, symmetry_breaking=True,
+                 assumptions=None, max_units_per_semester=MAX_UNITS_PER_SEMESTER):
     # Creates the model.
     model = cp_model.CpModel()
 
     # Creates class variables.
-    # classes[(p,c,s)]: professor 'p' teaches class 'c'
+    # classes[(p,s)]: professor with id 'p' teaches section with id 's'
+    # only create variables for the classes that professors can teach,
+    # a missing pair means the professor doesn't teach the class
     classes = {}
+    section_classes = {section.id: [] for section in sections.values()}  # section id : [variable]
+    professor_classes = {professor.id: [] for professor in professors.values()}  # prof id : [(Section, variable)]
     for professor in professors.values():
         for section in sections.values():
-            classes[(professor.name, section.name)] = model.NewBoolVar(
-                '{} teaches {}'.format(professor.name, section.name))
+            if professor.can_teach(section.course):
+                variable = model.NewBoolVar('{} teaches {}'.format(professor.name, section.name))
+                classes[(professor.id, section.id)] = variable
+                section_classes[section.id].append(variable)
+                professor_classes[professor.id].append((section, variable))
 
     # hard constraints
 
     # Each class is assigned to one professor or no professor.
     # allow the optional classes to be not assigned
     # schedule the courses that must be offered
-    for section_name, section in sections.items():
+    for section in sections.values():
         if section.must_offer:
-            model.Add(sum(classes[(prof_name, section_name)] for prof_name in professors) == 1)
+            literal = assumption_literal(model, assumptions, section.name + ' must be offered')
+            enforce(model.Add(cp_model.LinearExpr.Sum(section_classes[section.id]) == 1), literal)
         else:
-            model.Add(sum(classes[(prof_name, section_name)] for prof_name in professors) <= 1)
-
-    # Only schedule classes that professors can teach
-    for prof_name, professor in professors.items():
-        for section_name, section in sections.items():
-            model.Add(professor.can_teach(section.course) == 1).OnlyEnforceIf(classes[(prof_name, section_name)])
+            model.Add(cp_model.LinearExpr.Sum(section_classes[section.id]) <= 1)
 
     # Professors cannot teach more than their max number of units
     # 12 units per semester max
-    for prof_name, professor in professors.items():
-        model.Add(
-            sum(
-                classes[(prof_name, section_name)] * section.units
-                for section_name, section in sections.items()
-            ) <= professor.max_units
-        )
+    for professor in professors.values():
+        teaches = professor_classes[professor.id]
+        literal = assumption_literal(
+            model, assumptions, '{} teaches at most {} units'.format(professor.name, professor.max_units))
+        enforce(model.Add(cp_model.LinearExpr.WeightedSum(
+            [variable for _, variable in teaches],
+            [section.units for section, _ in teaches]
+        ) <= professor.max_units), literal)
         for semester in semesters:
-            model.Add(
-                sum(
-                    classes[(prof_name, section_name)] * section.units
-                    for section_name, section in sections.items()
-                    if section.semester == semester
-                ) <= MAX_UNITS_PER_SEMESTER
-            )
+            semester_teaches = [(section, variable) for section, variable in teaches if section.semester == semester]
+            literal = assumption_literal(model, assumptions, '{} teaches at most {} units in {}'.format(
+                professor.name, max_units_per_semester, semester))
+            enforce(model.Add(cp_model.LinearExpr.WeightedSum(
+                [variable for _, variable in semester_teaches],
+                [section.units for section, _ in semester_teaches]
+            ) <= max_units_per_semester), literal)
+
+    # the previous schedule may list interchangeable sections in any order,
+    # so don't break the symmetry when staying close to it
+    if symmetry_breaking and not minimal_change:
+        add_section_symmetry_breaking(model, classes, professors, sections)
 
     # soft constraints
 
     # assign classes according to prof preference
-    model.Maximize(sum(
-        classes[(prof_name, section_name)] * professor.prefers(section.course)
-        for prof_name, professor in professors.items()
-        for section_name, section in sections.items()
-    ))
+    preferred = [
+        variable
+        for professor in professors.values()
+        for section, variable in professor_classes[professor.id]
+        if professor.prefers(section.course)
+    ]
+    requests = cp_model.LinearExpr.Sum(preferred)
+    if previous is None:
+        model.Maximize(requests)
+        return model, classes
+
+    # start the search from the previous schedule
+    for key, variable in classes.items():
+        model.AddHint(variable, int(key in previous))
+    if minimal_change:
+        # number of pairs that are assigned differently, it is less than len(classes) + 1
+        # so meeting one more request always outweighs the changes
+        changes = cp_model.LinearExpr.Sum([
+            variable.Not() if key in previous else variable for key, variable in classes.items()
+        ])
+        model.Maximize((len(classes) + 1) * requests - changes)
+    else:
+        model.Maximize(requests)
 
     return model, classes
 
 
-def solve_model(model):
-    # Creates the solver and solve.
+# sections of the same course and semester that are both must offer or both optional are interchangeable,
+# any schedule stays valid with the same objective when their professors are swapped.
+# keep only one of these schedules: the professors of the sections are numbered from 1 (0 when not assigned)
+# and the numbers can't increase from one section to the next, so the assigned optional sections come first
+def add_section_symmetry_breaking(model, classes, professors, sections):
+    groups = {}  # (course, semester, must offer) : [Section]
+    for section in sections.values():
+        groups.setdefault((section.course, section.semester, section.must_offer), []).append(section)
+
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        group.sort(key=lambda section: section.section)
+        teachers = [professor.id for professor in professors.values() if professor.can_teach(group[0].course)]
+        numbers = [
+            cp_model.LinearExpr.WeightedSum(
+                [classes[(prof_id, section.id)] for prof_id in teachers],
+                list(range(1, len(teachers) + 1))
+            )
+            for section in group
+        ]
+        for number, next_number in zip(numbers, numbers[1:]):
+            model.Add(number >= next_number)
+
+
+# sections of the same course taught by the same professor are interchangeable in the timetable,
+# keep their time slot indexes in the order of the sections
+def add_timetable_symmetry_breaking(model, time_assign, profs_classes, sections, times):
+    section_by_id = {section.id: section for section in sections.values()}
+    groups = {}  # (professor id, course) : [class]
+    for c in profs_classes:
+        groups.setdefault((c[0], section_by_id[c[1]].course), []).append(c)
+
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        group.sort(key=lambda c: section_by_id[c[1]].section)
+        slots = []
+        for c in group:
+            allowed = [t for t in range(len(times)) if (c, t) in time_assign]
+            slots.append(cp_model.LinearExpr.WeightedSum([time_assign[(c, t)] for t in allowed], allowed))
+        for slot, next_slot in zip(slots, slots[1:]):
+            model.Add(slot <= next_slot)
+
+
+# with an assumptions dict {literal index : description}, create an assumption literal
+# enforcing a group of hard constraints, so that an infeasible model can tell which groups conflict
+# return None without assumptions
+def assumption_literal(model, assumptions, description):
+    if assumptions is None:
+        return None
+    literal = model.NewBoolVar(description)
+    model.AddAssumption(literal)
+    assumptions[literal.Index()] = description
+    return literal
+
+
+# only enforce the constraint when the assumption literal is true
+def enforce(constraint, literal):
+    if literal is not None:
+        constraint.OnlyEnforceIf(literal)
+    return constraint
+
+
+# return a minimal set of descriptions of assumptions that make the model infeasible
+# the model is built with an assumptions dict, see assumption_literal
+# with a time limit in the settings, the whole explanation gets that many seconds: when they run out
+# the core found so far is returned without being minimized (an empty list if none was found)
+def explain_infeasibility(model, assumptions, settings=None):
+    if settings is None:
+        settings = SolverSettings()
+    deadline = None if settings.time_limit is None else time.time() + settings.time_limit
+    solver = solve_for_core(model, settings, deadline)
+    if solver.StatusName() != 'INFEASIBLE':
+        return []
+    core = list(solver.SufficientAssumptionsForInfeasibility())
+
+    # drop the assumptions that aren't needed for the infeasibility, one at a time
+    for index in list(core):
+        if deadline is not None and time.time() >= deadline:
+            break
+        rest = [i for i in core if i != index]
+        model.ClearAssumptions()
+        model.AddAssumptions([model.GetBoolVarFromProtoIndex(i) for i in rest])
+        if solve_for_core(model, settings, deadline).StatusName() == 'INFEASIBLE':
+            core = rest
+    return [assumptions[i] for i in core]
+
+
+# solve of explain_infeasibility, stopped at the deadline
+def solve_for_core(model, settings, deadline):
     solver = cp_model.CpSolver()
+    settings.apply(solver)
+    # the infeasibility core is only reported by a single worker
+    solver.parameters.num_search_workers = 1
+    if deadline is not None:
+        solver.parameters.max_time_in_seconds = max(0.0, deadline - time.time())
     solver.Solve(model)
-    assert solver.StatusName() != 'INFEASIBLE', 'PROBLEM IS INFEASIBLE'
     return solver
 
 
+# the solver proved that a model has no solution
+class InfeasibleError(AssertionError):
+    pass
+
+
+# the solver stopped without a solution (time limit, invalid model), status is its status name
+class NoSolutionError(AssertionError):
+
+    def __init__(self, status):
+        AssertionError.__init__(self, status)
+        self.status = status
+
+    def __str__(self):
+        return 'NO SOLUTION FOUND, SOLVER STATUS ' + self.status
+
+
+# parameters for the CP-SAT solves
+# time_limit is in seconds for each solve, num_workers is the number of search workers (0 uses the solver default)
+# relative_gap stops the search once the objective is proven to be within that fraction of the best bound
+# log prints the CP-SAT search log, anytime prints every improving solution as it is found
+class SolverSettings:
+
+    def __init__(self, time_limit=None, num_workers=0, relative_gap=None, random_seed=None, log=False,
+                 anytime=False):
+        self.time_limit = time_limit
+        self.num_workers = num_workers
+        self.relative_gap = relative_gap
+        self.random_seed = random_seed
+        self.log = log
+        self.anytime = anytime
+
+    def apply(self, solver):
+        if self.time_limit is not None:
+            solver.parameters.max_time_in_seconds = self.time_limit
+        if self.num_workers:
+            solver.parameters.num_search_workers = self.num_workers
+        if self.relative_gap is not None:
+            solver.parameters.relative_gap_limit = self.relative_gap
+        if self.random_seed is not None:
+            solver.parameters.random_seed = self.random_seed
+        solver.parameters.log_search_progress = self.log
+
+    # copy of the settings for solves running next to each other in processes,
+    # the search workers are split between them
+    def split(self, processes):
+        settings = copy.copy(self)
+        settings.num_workers = max(1, (self.num_workers or os.cpu_count() or 1) // processes)
+        return settings
+
+
+# print every improving solution with the best bound, used by the anytime mode
+class ProgressPrinter(cp_model.CpSolverSolutionCallback):
+
+    def __init__(self):
+        cp_model.CpSolverSolutionCallback.__init__(self)
+        self.solutions = 0
+
+    def OnSolutionCallback(self):
+        self.solutions += 1
+        print('  solution %i: objective %i, bound %i, %.2f s' % (
+            self.solutions, self.ObjectiveValue(), self.BestObjectiveBound(), self.WallTime()))
+
+
+# timings and statistics of a run, collected while profiling is on (see start_profiling)
+# phases nest, a phase is named by the path of the phases it runs in, like 'assignment/solve'
+class Profiler:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stack = []
+        self.phases = []  # {'phase': path, 'seconds': wall time}, in the order they start
+        self.solves = []  # {'phase': path, 'model': model_statistics, 'search': search_statistics}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.stack.append(name)
+        record = {'phase': '/'.join(self.stack), 'seconds': None}
+        self.phases.append(record)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self.stack.pop()
+
+    def record_solve(self, model, solver):
+        self.solves.append({
+            'phase': '/'.join(self.stack),
+            'model': model_statistics(model),
+            'search': search_statistics(model, solver),
+        })
+
+    def report(self):
+        return {
+            'total_seconds': time.perf_counter() - self.start,
+            'peak_memory_mb': peak_memory_mb(),
+            'phases': self.phases,
+            'solves': self.solves,
+        }
+
+
+# the active Profiler, None when profiling is off
+PROFILER = None
+
+
+# context manager timing a phase of the run when profiling is on
+def profile_phase(name):
+    if PROFILER is None:
+        return contextlib.nullcontext()
+    return PROFILER.phase(name)
+
+
+def start_profiling():
+    global PROFILER
+    PROFILER = Profiler()
+    return PROFILER
+
+
+# stop profiling, print the phase timings and write the whole report to a json file
+def stop_profiling(file_name=None):
+    global PROFILER
+    report = PROFILER.report()
+    PROFILER = None
+    print('Profile (total %.3f s, peak memory %.1f MB)' % (report['total_seconds'], report['peak_memory_mb']))
+    for record in report['phases']:
+        depth = record['phase'].count('/')
+        print('  %s%-*s %9.3f s' % ('  ' * depth, 30 - 2 * depth, record['phase'].split('/')[-1],
+                                    record['seconds'] or 0))
+    print()
+    if file_name is not None:
+        with open(file_name, 'w') as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+# size of a CP-SAT model: variables, constraints by type, literals and terms in the constraints
+# (enforcement literals, literals of boolean constraints and terms of linear constraints) and proto bytes
+def model_statistics(model):
+    proto = model.Proto()
+    constraint_types = {}
+    literals = 0
+    for constraint in proto.constraints:
+        kind = constraint.WhichOneof('constraint')
+        constraint_types[kind] = constraint_types.get(kind, 0) + 1
+        literals += len(constraint.enforcement_literal)
+        if kind in ('bool_or', 'bool_and', 'at_most_one', 'exactly_one'):
+            literals += len(getattr(constraint, kind).literals)
+        elif kind == 'linear':
+            literals += len(constraint.linear.vars)
+    return {
+        'variables': len(proto.variables),
+        'boolean_variables': sum(list(variable.domain) == [0, 1] for variable in proto.variables),
+        'constraints': len(proto.constraints),
+        'constraint_types': constraint_types,
+        'literals': literals,
+        'objective_terms': len(proto.objective.vars),
+        'bytes': proto.ByteSize(),
+    }
+
+
+# statistics of a CP-SAT search, with the objective, best bound and relative gap for optimization models
+def search_statistics(model, solver):
+    statistics = {
+        'status': solver.StatusName(),
+        'wall_time': solver.WallTime(),
+        'user_time': solver.UserTime(),
+        'branches': solver.NumBranches(),
+        'conflicts': solver.NumConflicts(),
+    }
+    if model.HasObjective() and statistics['status'] in ('OPTIMAL', 'FEASIBLE'):
+        objective = solver.ObjectiveValue()
+        bound = solver.BestObjectiveBound()
+        statistics['objective'] = objective
+        statistics['best_bound'] = bound
+        statistics['gap'] = abs(objective - bound) / max(1.0, abs(objective))
+    return statistics
+
+
+# peak resident memory of the process in MB, 0 where the resource module isn't available
+def peak_memory_mb():
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+# listener of the CP-SAT solves of the current thread, used by the scheduling service (service.py)
+# to stream progress and cancel solves. SOLVE_LISTENER.listener has start(solver, callback), which returns
+# the callback to use, finish(solver), called after the search, and check(), which raises if it is cancelled
+SOLVE_LISTENER = threading.local()
+# seconds between the cancellation checks while waiting for a process pool
+CANCEL_CHECK_INTERVAL = 0.2
+
+
+# raise if the solve listener of the current thread is cancelled, for the work that doesn't go through
+# solve_model in this thread (LNS rounds, process pools)
+def check_cancelled():
+    listener = getattr(SOLVE_LISTENER, 'listener', None)
+    if listener is not None:
+        listener.check()
+
+
+# process pool for the parallel solves. the workers are spawned rather than forked: forking a process
+# with running threads (CP-SAT workers, the service's request threads) can leave locks held in the child
+# on an error or a cancel, the pending tasks are dropped without waiting for the running ones
+@contextlib.contextmanager
+def process_pool(processes, initializer=None, initargs=()):
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=initializer,
+                                                      initargs=initargs,
+                                                      mp_context=multiprocessing.get_context('spawn'))
+    try:
+        yield executor
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+
+# results of the futures in order, checking for cancellation while they run
+def pool_results(futures):
+    pending = set(futures)
+    while pending:
+        check_cancelled()
+        _, pending = concurrent.futures.wait(pending, timeout=CANCEL_CHECK_INTERVAL)
+    return [future.result() for future in futures]
+
+
+# solve a model with the settings, return the solver with the best solution found
+# callback is a CpSolverSolutionCallback called on each improving solution,
+# in anytime mode a ProgressPrinter is used if none is given
+# when the time limit stops the search, the best solution found so far is used
+def solve_model(model, settings=None, callback=None):
+    if settings is None:
+        settings = SolverSettings()
+    # Creates the solver and solve.
+    solver = cp_model.CpSolver()
+    settings.apply(solver)
+    if callback is None and settings.anytime:
+        callback = ProgressPrinter()
+    listener = getattr(SOLVE_LISTENER, 'listener', None)
+    if listener is not None:
+        callback = listener.start(solver, callback)
+    try:
+        solver.Solve(model, callback)
+    finally:
+        if listener is not None:
+            listener.finish(solver)
+    if PROFILER is not None:
+        PROFILER.record_solve(model, solver)
+    status = solver.StatusName()
+    if status == 'INFEASIBLE':
+        raise InfeasibleError('PROBLEM IS INFEASIBLE')
+    if status not in ('OPTIMAL', 'FEASIBLE'):
+        raise NoSolutionError(status)
+    if status == 'FEASIBLE' and model.HasObjective():
+        print('Solution not proven optimal after %.2f s: objective %i, bound %i' % (
+            solver.WallTime(), solver.ObjectiveValue(), solver.BestObjectiveBound()))
+    return solver
+
+
+# keys of the variables set to 1 in the solution, the values are read in one call
+# variables : {key : BoolVar}
+def chosen_keys(solver, variables):
+    solution = np.asarray(solver.ResponseProto().solution)
+    keys = list(variables)
+    indices = np.fromiter((variable.Index() for variable in variables.values()), dtype=np.int64,
+                          count=len(keys))
+    return [keys[i] for i in np.flatnonzero(solution[indices] == 1)]
+
+
+# {section id : professor id} of the assigned classes in the solution
+def assigned_professors(solver, classes):
+    return {section_id: prof_id for prof_id, section_id in chosen_keys(solver, classes)}
+
+
 def print_results(solver, classes, professors, sections, semesters):
+    teacher = assigned_professors(solver, classes)
+    professor_by_id = {professor.id: professor for professor in professors.values()}
     # print in course-first format
+    requests_met = 0
     for semester in semesters:
         print(semester)
         for _, section in sorted(sections.items()):
-            if section.semester != semester:
+            if section.semester != semester or section.id not in teacher:
                 continue
-            for _, professor in sorted(professors.items()):
-                if solver.Value(classes[(professor.name, section.name)]) == 1:
-                    if professor.prefers(section.course):
-                        print(section.name + ' assigned to ' + professor.name + ' (requested)')
-                    else:
-                        print(section.name + ' assigned to ' + professor.name + ' (not requested)')
-                    break
+            professor = professor_by_id[teacher[section.id]]
+            if professor.prefers(section.course):
+                requests_met += 1
+                print(section.name + ' assigned to ' + professor.name + ' (requested)')
+            else:
+                print(section.name + ' assigned to ' + professor.name + ' (not requested)')
         print()
 
     # print in professor-first format
@@ -342,7 +1067,7 @@ def print_results(solver, classes, professors, sections, semesters):
             for _, section in sorted(sections.items()):
                 if section.semester != semester:
                     continue
-                if solver.Value(classes[(professor.name, section.name)]) == 1:
+                if teacher.get(section.id) == professor.id:
                     if professor.prefers(section.course):
                         print(professor.name + ' will be teaching ' + section.name + ' (requested)')
                     else:
@@ -351,31 +1076,73 @@ def print_results(solver, classes, professors, sections, semesters):
 
     # Statistics.
     print('Statistics')
-    print('  - Number of requests met = %i' % solver.ObjectiveValue())
+    print('  - status          : %s' % solver.StatusName())
+    print('  - Number of requests met = %i' % requests_met)
     print('  - wall time       : %f s' % solver.WallTime())
     print()
 
 
 # return infos for timeslots scheduling
-# list of scheduled classes tuple (professor.name, section.name) , listed by semesters
+# list of scheduled classes tuple (professor.id, section.id) , listed by semesters
 def get_semester_schedule(solver, classes, professors, sections, semesters):
-    scheduled_classes = {}
-    for semester in semesters:
-        profs_classes = []
-        for section in sections.values():
-            if section.semester != semester:
-                continue
-            for professor in professors.values():
-                if solver.Value(classes[(professor.name, section.name)]) == 1:
-                    profs_classes.append((professor.name, section.name))
-                    break
-        scheduled_classes[semester] = profs_classes
+    teacher = assigned_professors(solver, classes)
+    scheduled_classes = {semester: [] for semester in semesters}
+    for section in sections.values():
+        if section.id in teacher and section.semester in scheduled_classes:
+            scheduled_classes[section.semester].append((teacher[section.id], section.id))
     return scheduled_classes
 
 
+# classes in time slot t and in the slots overlapping it, occupancy is indexed by time slot and holds
+# numbers or model variables. the slot conflicts with itself, so a class in it is counted once
+def slot_load(occupancy, conflict_index, t):
+    return sum(occupancy[t2] for t2 in conflict_index.neighbors[t])
+
+
+# occupancy encoding of the conflicts: count how many classes occupy each time slot and its load,
+# a class then conflicts with every other class in the load of its slot.
+# this gives the same count as the pairwise encoding with slots x (conflicting slots + classes) terms
+# slot_literals is {class : {time slot index : literal of the class in the slot}}
+# return {class : variable of the number of classes it conflicts with}, prefix starts the variable names
+def add_occupancy_conflicts(model, slot_literals, conflict_index, num_slots, prefix=''):
+    in_slot = [[] for _ in range(num_slots)]
+    for literals in slot_literals.values():
+        for t, literal in literals.items():
+            in_slot[t].append(literal)
+    occupancy = []
+    for t in range(num_slots):
+        occupancy.append(model.NewIntVar(0, len(slot_literals), prefix + 'classes in timeslot {}'.format(t)))
+        model.Add(occupancy[t] == sum(in_slot[t]))
+    load = []
+    for t in range(num_slots):
+        load.append(model.NewIntVar(0, len(slot_literals), prefix + 'classes overlapping timeslot {}'.format(t)))
+        model.Add(load[t] == slot_load(occupancy, conflict_index, t))
+    overlaps = {}
+    for c, literals in slot_literals.items():
+        overlaps[c] = model.NewIntVar(0, max(len(slot_literals) - 1, 0), prefix + '{} conflicts'.format(c))
+        for t, literal in literals.items():
+            model.Add(overlaps[c] >= load[t] - 1).OnlyEnforceIf(literal)
+    return overlaps
+
+
 # create a model for timetable scheduling
-def create_timetable_model(profs_classes, professors, sections, times):
-    prof_teach = {}  # professor : a list of scheduled classes
+# profs_classes is a list of (professor.id, section.id), time slots are identified by their index in times
+# conflict_encoding is either 'occupancy' (counts classes per time slot)
+# or 'pairwise' (one variable per pair of conflicting classes, slow on big inputs)
+# conflict_index is the ConflictIndex of times, built here if not given
+# previous_slots is {(professor id, section id) : time slot index} from an earlier schedule, used as hints
+# with minimal_change, among the best timetables pick the one moving the fewest classes from previous_slots
+# symmetry_breaking orders the time slots of interchangeable sections, see add_timetable_symmetry_breaking
+# with an assumptions dict, the hard constraints are enforced by assumption literals, see assumption_literal
+# weights are the objective weights from timetable_weights, computed from the arguments if not given
+def create_timetable_model(profs_classes, professors, sections, times, conflict_encoding='occupancy',
+                           conflict_index=None, previous_slots=None, minimal_change=False,
+                           symmetry_breaking=True, assumptions=None, weights=None):
+    if conflict_index is None:
+        conflict_index = ConflictIndex(times)
+    professor_by_id = {professor.id: professor for professor in professors.values()}
+    section_by_id = {section.id: section for section in sections.values()}
+    prof_teach = {}  # professor id : a list of scheduled section ids
     for prof_sec in profs_classes:
         prof = prof_sec[0]
         sec = prof_sec[1]
@@ -384,148 +1151,1182 @@ def create_timetable_model(profs_classes, professors, sections, times):
         else:
             prof_teach[prof] = [sec]
 
+    # time slots each class can be given, lab sections only go to lab time slots and other sections
+    # to non-lab time slots. when explaining infeasibility, all slots are allowed and the lab rule
+    # is a constraint behind an assumption literal
+    allowed = {}  # class : [time slot index]
+    for c in profs_classes:
+        section_lab = section_by_id[c[1]].lab
+        if assumptions is None:
+            allowed[c] = [t for t, time_slot in enumerate(times) if time_slot.lab == section_lab]
+        else:
+            allowed[c] = list(range(len(times)))
+
     # Creates the model.
     model = cp_model.CpModel()
     # Creates variables.
-    # c - tuple (professor, section), t - time
+    # c - tuple (professor id, section id), t - index of the time slot
+    # a missing pair means the class can't be given that time slot
     time_assign = {}
     for c in profs_classes:
-        for t in times:
-            time_assign[(c, t)] = model.NewBoolVar(
-                '{} teaches {} in timeslot {}'.format(c[0], c[1], times.index(t))
-            )
+        for t in allowed[c]:
+            time_assign[(c, t)] = model.NewBoolVar('{} teaches {} in timeslot {}'.format(c[0], c[1], t))
 
     # hard constraints
     # Each class is assigned to exactly one time slot.
     for c in profs_classes:
-        model.Add(sum(time_assign[(c, t)] for t in times) == 1)
+        literal = assumption_literal(model, assumptions, '{} teaches {} in one time slot'.format(
+            professor_by_id[c[0]].name, section_by_id[c[1]].name))
+        enforce(model.Add(sum(time_assign[(c, t)] for t in allowed[c]) == 1), literal)
 
     # only lab sections are assign to lab time slots
-    is_lab = {}
-    for prof_name, sec_name in prof_teach.items():
-        for s in sec_name:
-            for t in times:
-                # create intermediate boolean variables
-                lab_key = (s, t)
-                is_lab[lab_key] = model.NewBoolVar(
-                    '{} section lab {}, timeslots {} lab {}'.format(s, sections[s].lab, t, t.lab))
-                # variables are true when both the section and time are labs
-                # or when both are not labs
-                if sections[s].lab == t.lab:
-                    model.Add(is_lab[lab_key] == 1)
-                else:
-                    model.Add(is_lab[lab_key] == 0)
-                model.Add(is_lab[lab_key] == 1).OnlyEnforceIf(time_assign[(prof_name, s), t])
+    if assumptions is not None:
+        for c in profs_classes:
+            section = section_by_id[c[1]]
+            literal = assumption_literal(model, assumptions, '{} is in a {} time slot'.format(
+                section.name, 'lab' if section.lab else 'non-lab'))
+            wrong_slots = [time_assign[(c, t)] for t in allowed[c] if times[t].lab != section.lab]
+            enforce(model.Add(sum(wrong_slots) == 0), literal)
 
     # time slots for a professor don't conflict
-    for prof_name, sec_name in prof_teach.items():
-        for s1 in sec_name:
-            for s2 in sec_name:
-                if s1 != s2:
-                    for t1 in times:
-                        for t2 in times:
-                            if t1 in t2.conflicts:
-                                content = [time_assign[((prof_name, s1), t1)], time_assign[((prof_name, s2), t2)]]
-                                model.AddMultiplicationEquality(0, content)
+    # a professor teaches at most one class in each group of conflicting time slots
+    for prof_id, sec_ids in prof_teach.items():
+        if len(sec_ids) < 2:
+            continue
+        literal = assumption_literal(model, assumptions, "{}'s classes don't overlap".format(
+            professor_by_id[prof_id].name))
+        for clique in conflict_index.cliques:
+            in_clique = [
+                time_assign[((prof_id, s), t)]
+                for s in sec_ids
+                for t in clique
+                if ((prof_id, s), t) in time_assign
+            ]
+            if len(in_clique) > 1:
+                enforce(model.Add(sum(in_clique) <= 1), literal)
+
+    if symmetry_breaking and not minimal_change:
+        add_timetable_symmetry_breaking(model, time_assign, profs_classes, sections, times)
 
     # Minimize the overall time conflicts
-    conflicts = {}
-    conflict_name_template = 'course {} (timeslot {}) and course {} (timeslot {}) conflict'
-    for time1 in times:
-        for time2 in times:
-            if not time1.conflict(time2):
-                continue
-            for course1 in profs_classes:
-                for course2 in profs_classes:
-                    if course1 == course2:
-                        continue
-                    # (course1, time1) && (course2, time2) -> (course1, time1, course2, time2)
-                    key = (course1, time1, course2, time2)
-                    # create the conflict variable
-                    conflicts[key] = model.NewBoolVar(conflict_name_template.format(*key))
-                    model.Add(conflicts[key] == 1).OnlyEnforceIf([
-                        time_assign[(course1, time1)],
-                        time_assign[(course2, time2)],
-                    ])
+    if conflict_encoding == 'pairwise':
+        # one variable per pair of classes and pair of conflicting time slots
+        conflicts = {}
+        conflict_name_template = 'course {} (timeslot {}) and course {} (timeslot {}) conflict'
+        for time1 in range(len(times)):
+            for time2 in conflict_index.neighbors[time1]:
+                for course1 in profs_classes:
+                    for course2 in profs_classes:
+                        if course1 == course2:
+                            continue
+                        if (course1, time1) not in time_assign or (course2, time2) not in time_assign:
+                            continue
+                        # (course1, time1) && (course2, time2) -> (course1, time1, course2, time2)
+                        key = (course1, time1, course2, time2)
+                        # create the conflict variable
+                        conflicts[key] = model.NewBoolVar(conflict_name_template.format(*key))
+                        model.Add(conflicts[key] == 1).OnlyEnforceIf([
+                            time_assign[(course1, time1)],
+                            time_assign[(course2, time2)],
+                        ])
+        total_conflicts = sum(conflicts.values())
+    elif conflict_encoding == 'occupancy':
+        slot_literals = {c: {t: time_assign[(c, t)] for t in allowed[c]} for c in profs_classes}
+        total_conflicts = sum(add_occupancy_conflicts(model, slot_literals, conflict_index, len(times)).values())
+    else:
+        raise ValueError('unknown conflict encoding', conflict_encoding)
+    if weights is None:
+        weights = timetable_weights(profs_classes, times, conflict_index)
+    conflict_weight, prefer_weight = weights
 
     # Maximize the number of time slots that profs prefer
     # should create a variable only if a professor prefers a time slot
     # but the solver will schedule more classes that are not preferred
     # so created a variable for all combination instead.
     prefer_time = {}
-    for prof_name, sec_name in prof_teach.items():
-        for s in sec_name:
-            for t in times:
-                key = (prof_name, s, t)
+    for prof_id, sec_ids in prof_teach.items():
+        professor = professor_by_id[prof_id]
+        for s in sec_ids:
+            for t in allowed[(prof_id, s)]:
+                time_slot = times[t]
+                key = (prof_id, s, t)
                 # create the preferences variables
-                prefer_time[key] = model.NewBoolVar('{} teaches course {} on timeslots {}'.format(prof_name, s, t))
+                prefer_time[key] = model.NewBoolVar('{} teaches course {} on timeslots {}'.format(*key))
                 model.Add(prefer_time[key] ==
-                          (professors[prof_name].prefer_time(t))).OnlyEnforceIf(
-                    [time_assign[((prof_name, s), t)]]
+                          (professor.prefer_time(time_slot))).OnlyEnforceIf(
+                    [time_assign[((prof_id, s), t)]]
                 )
 
-    # equalize their importance, then multiple by their weights
-    model.Minimize(3 * len(prefer_time) * sum(conflicts.values())
-                   - 2 * len(conflicts) * sum(prefer_time.values()))
+    objective = conflict_weight * total_conflicts - prefer_weight * sum(prefer_time.values())
+    if not previous_slots:
+        model.Minimize(objective)
+        return model, time_assign
+
+    # start the search from the previous timetable
+    moved = []
+    for c in profs_classes:
+        # skip the classes whose previous time slot isn't allowed anymore
+        if (c, previous_slots.get(c)) not in time_assign:
+            continue
+        for t in allowed[c]:
+            model.AddHint(time_assign[(c, t)], int(t == previous_slots[c]))
+        moved.append(time_assign[(c, previous_slots[c])].Not())
+    if minimal_change:
+        # at most len(profs_classes) classes move, so the timetable objective stays first
+        model.Minimize((len(profs_classes) + 1) * objective + sum(moved))
+    else:
+        model.Minimize(objective)
 
     return model, time_assign
 
 
+# weights of the conflicts and of the preferred time slots in the timetable objective
+# the number of possible conflicts and time preferences for all classes and time slots equalize
+# their importance, the same in both encodings, then they are multiplied by their weights
+def timetable_weights(profs_classes, times, conflict_index):
+    num_conflict_terms = len(profs_classes) * (len(profs_classes) - 1) * conflict_index.num_conflicts()
+    num_prefer_terms = len(profs_classes) * len(times)
+    return 3 * num_prefer_terms, 2 * num_conflict_terms
+
+
+# return the timetable of one semester
+# list of (class tuple (professor.id, section.id), index of the assigned time slot)
+def get_semester_timetable(solver, time_assign, profs_classes, times):
+    slot_of = dict(chosen_keys(solver, time_assign))
+    return [(c, slot_of[c]) for c in profs_classes if c in slot_of]
+
+
+# group the time slots that are interchangeable in the timetable model of a semester:
+# the same lab flag, the same answer to prefer_time for each of the semester's professors and the same
+# conflicting slots (so they conflict with each other, like parallel copies of a slot)
+# return the groups as lists of slot indices, in the order of their first slot
+def slot_equivalence_classes(profs_classes, professors, times, conflict_index):
+    prof_ids = sorted({prof_id for prof_id, _ in profs_classes})
+    professor_by_id = {professor.id: professor for professor in professors.values()}
+    groups = {}
+    for t, time_slot in enumerate(times):
+        signature = tuple(professor_by_id[prof_id].prefer_time(time_slot) for prof_id in prof_ids)
+        groups.setdefault((conflict_index.bits[t], time_slot.lab, signature), []).append(t)
+    return list(groups.values())
+
+
+# map a timetable over one slot per group back to the slots of the groups
+# a class keeps its previous slot when it is in the chosen group, the other classes of a group
+# are spread over its slots in turn
+def expand_timetable(timetable, groups, previous_slots=None):
+    if previous_slots is None:
+        previous_slots = {}
+    used = [0] * len(groups)
+    expanded = []
+    for c, g in timetable:
+        if previous_slots.get(c) in groups[g]:
+            expanded.append((c, previous_slots[c]))
+        else:
+            expanded.append((c, groups[g][used[g] % len(groups[g])]))
+            used[g] += 1
+    return expanded
+
+
+# build and solve the timetable model for one semester, return its timetable
+# with compress, equivalent time slots are merged (see slot_equivalence_classes), the model is solved over
+# one slot per group with the objective weights of the full grid and the timetable is expanded back
+# with the 'lns' engine the (merged) timetable is solved by lns_timetable, which uses the processes
+def solve_semester_timetable(profs_classes, professors, sections, times, conflict_encoding='occupancy',
+                             settings=None, conflict_index=None, previous_slots=None, minimal_change=False,
+                             symmetry_breaking=True, compress=True, weights=None, engine='exact', processes=1):
+    if compress:
+        if conflict_index is None:
+            conflict_index = ConflictIndex(times)
+        with profile_phase('compress'):
+            groups = slot_equivalence_classes(profs_classes, professors, times, conflict_index)
+        if len(groups) < len(times):
+            group_of = {t: g for g, group in enumerate(groups) for t in group}
+            reduced_slots = None
+            if previous_slots:
+                reduced_slots = {c: group_of[t] for c, t in previous_slots.items() if t in group_of}
+            representatives = [times[group[0]] for group in groups]
+            timetable = solve_semester_timetable(profs_classes, professors, sections, representatives,
+                                                 conflict_encoding, settings, ConflictIndex(representatives),
+                                                 reduced_slots, minimal_change, symmetry_breaking, False,
+                                                 timetable_weights(profs_classes, times, conflict_index), engine,
+                                                 processes)
+            return expand_timetable(timetable, groups, previous_slots)
+
+    if engine == 'lns':
+        return lns_timetable(profs_classes, professors, sections, times, conflict_encoding, settings, conflict_index,
+                             previous_slots, processes, minimal_change=minimal_change,
+                             symmetry_breaking=symmetry_breaking, weights=weights)
+
+    with profile_phase('build'):
+        model, time_assign = create_timetable_model(profs_classes, professors, sections, times,
+                                                    conflict_encoding, conflict_index, previous_slots,
+                                                    minimal_change, symmetry_breaking, weights=weights)
+    try:
+        with profile_phase('solve'):
+            solver = solve_model(model, settings)
+    except InfeasibleError:
+        # build the model again with assumptions to find out which constraints conflict
+        assumptions = {}
+        model, _ = create_timetable_model(profs_classes, professors, sections, times,
+                                          conflict_encoding, conflict_index, previous_slots, minimal_change,
+                                          symmetry_breaking, assumptions, weights)
+        core = explain_infeasibility(model, assumptions, settings)
+        raise InfeasibleError('TIMETABLE IS INFEASIBLE, conflicting constraints: ' + '; '.join(core))
+    with profile_phase('extract'):
+        return get_semester_timetable(solver, time_assign, profs_classes, times)
+
+
+# solve the timetable of every semester, return {semester : timetable}
+# semesters share no variables, so with more than one process they are solved in a process pool
+# and the CP-SAT search workers are split between the processes
+# with the 'lns' engine, semesters are solved one after the other by lns_timetable,
+# which uses the processes for its neighborhoods and honours the other options like the exact engine
+def solve_timetables(scheduled_classes, semesters, professors, sections, times,
+                     conflict_encoding='occupancy', processes=1, conflict_index=None,
+                     previous_slots=None, minimal_change=False, settings=None, symmetry_breaking=True,
+                     engine='exact', compress=True):
+    if conflict_index is None:
+        conflict_index = ConflictIndex(times)
+    if settings is None:
+        settings = SolverSettings()
+    if engine not in ('exact', 'lns'):
+        raise ValueError('unknown engine', engine)
+    if engine == 'lns' or processes <= 1 or len(semesters) <= 1:
+        timetables = {}
+        for semester in semesters:
+            with profile_phase('timetable ' + semester):
+                timetables[semester] = solve_semester_timetable(
+                    scheduled_classes[semester], professors, sections, times, conflict_encoding, settings,
+                    conflict_index, previous_slots, minimal_change, symmetry_breaking, compress, engine=engine,
+                    processes=processes)
+        return timetables
+
+    processes = min(processes, len(semesters))
+    settings = settings.split(processes)
+    with process_pool(processes) as executor:
+        futures = [
+            executor.submit(solve_semester_timetable, scheduled_classes[semester], professors, sections, times,
+                            conflict_encoding, settings, conflict_index, previous_slots, minimal_change,
+                            symmetry_breaking, compress)
+            for semester in semesters
+        ]
+        # gather in semester order so the output doesn't depend on which solve finishes first
+        # (the profiler only sees the whole pool, the solves run in other processes)
+        return dict(zip(semesters, pool_results(futures)))
+
+
+# cost of a timetable as (overlapping classes of a professor, timetable objective), lower is better
+# slot_of : {class tuple : time slot index}, weights from timetable_weights
+def timetable_cost(slot_of, professor_by_id, times, conflict_index, weights, previous_slots=None):
+    occupancy = [0] * len(times)
+    for t in slot_of.values():
+        occupancy[t] += 1
+    prof_slots = {}
+    conflicts = 0
+    preferred = 0
+    for (prof_id, _), t in slot_of.items():
+        # as in the occupancy encoding, a class conflicts with the other classes in the load of its slot
+        conflicts += slot_load(occupancy, conflict_index, t) - 1
+        preferred += professor_by_id[prof_id].prefer_time(times[t])
+        prof_slots.setdefault(prof_id, []).append(t)
+    clashes = sum(conflict_index.conflict(t1, t2)
+                  for slots in prof_slots.values()
+                  for i, t1 in enumerate(slots)
+                  for t2 in slots[i + 1:])
+    moved = sum(previous_slots[c] != t for c, t in slot_of.items() if c in previous_slots) if previous_slots else 0
+    return clashes, weights[0] * conflicts - weights[1] * preferred, moved
+
+
+# professors teaching two classes in conflicting time slots
+def clashing_professors(slot_of, conflict_index):
+    prof_slots = {}
+    for (prof_id, _), t in slot_of.items():
+        prof_slots.setdefault(prof_id, []).append(t)
+    return [prof_id for prof_id, slots in prof_slots.items()
+            if any(conflict_index.conflict(t1, t2) for i, t1 in enumerate(slots) for t2 in slots[i + 1:])]
+
+
+# greedy starting timetable for the LNS, return {class tuple : time slot index}
+# the most constrained classes are placed first (fewest allowed time slots, then professors with the most
+# classes), each in the allowed slot that doesn't overlap the professor's other classes and adds the
+# fewest conflicts, preferring the professor's timeframe. a class keeps its previous time slot if it fits
+def greedy_timetable(profs_classes, professor_by_id, section_by_id, times, conflict_index, weights,
+                     previous_slots=None):
+    if previous_slots is None:
+        previous_slots = {}
+    allowed = {c: [t for t, time_slot in enumerate(times) if time_slot.lab == section_by_id[c[1]].lab]
+               for c in profs_classes}
+    no_slots = [section_by_id[c[1]].name for c in profs_classes if not allowed[c]]
+    if no_slots:
+        raise InfeasibleError('TIMETABLE IS INFEASIBLE, no time slots for ' + ', '.join(no_slots))
+    load = {}
+    for prof_id, _ in profs_classes:
+        load[prof_id] = load.get(prof_id, 0) + 1
+    order = sorted(profs_classes, key=lambda c: (len(allowed[c]), -load[c[0]], c))
+
+    # pressure[t]: classes placed in slots conflicting with t
+    # blocked[prof][t]: classes of the professor placed in slots conflicting with t
+    pressure = [0] * len(times)
+    blocked = {}
+    slot_of = {}
+    for c in order:
+        professor = professor_by_id[c[0]]
+        prof_blocked = blocked.setdefault(c[0], {})
+        slot_of[c] = min(allowed[c], key=lambda t: (
+            prof_blocked.get(t, 0),
+            t != previous_slots.get(c),
+            2 * weights[0] * pressure[t] - weights[1] * professor.prefer_time(times[t]),
+            t,
+        ))
+        for t2 in conflict_index.neighbors[slot_of[c]]:
+            pressure[t2] += 1
+            prof_blocked[t2] = prof_blocked.get(t2, 0) + 1
+    return slot_of
+
+
+# give the classes of a professor in the same course their time slots in section order, as
+# add_timetable_symmetry_breaking requires. the classes are interchangeable, so the cost doesn't change
+def order_symmetric_classes(slot_of, section_by_id):
+    groups = {}  # (professor id, course) : [class]
+    for c in slot_of:
+        groups.setdefault((c[0], section_by_id[c[1]].course), []).append(c)
+    ordered = dict(slot_of)
+    for group in groups.values():
+        group.sort(key=lambda c: section_by_id[c[1]].section)
+        for c, t in zip(group, sorted(slot_of[c] for c in group)):
+            ordered[c] = t
+    return ordered
+
+
+# pick the classes freed in one LNS step: the classes of a few professors, the classes in time slots
+# conflicting with a random class, or the classes meeting on a random weekday
+# while professors' classes overlap, the classes of one of them are freed first
+def choose_neighborhood(rng, profs_classes, slot_of, times, conflict_index, size, clashing):
+    freed = []
+    if clashing:
+        clashing = [rng.choice(clashing)]
+        freed = [c for c in profs_classes if c[0] == clashing[0]]
+    kind = rng.choice(['professors', 'sections', 'weekday'])
+    if kind == 'professors':
+        prof_ids = sorted({c[0] for c in profs_classes})
+        rng.shuffle(prof_ids)
+        by_professor = {}
+        for c in profs_classes:
+            by_professor.setdefault(c[0], []).append(c)
+        for prof_id in prof_ids:
+            if len(freed) >= size:
+                break
+            freed.extend(by_professor[prof_id])
+    elif kind == 'sections':
+        seed = rng.choice(profs_classes)
+        neighbors = conflict_index.bits[slot_of[seed]]
+        candidates = [c for c in profs_classes if neighbors >> slot_of[c] & 1]
+        rng.shuffle(candidates)
+        freed.extend(candidates)
+    else:
+        day = rng.randrange(len(times[0].weekdays))
+        candidates = [c for c in profs_classes if times[slot_of[c]].weekdays[day]]
+        rng.shuffle(candidates)
+        freed.extend(candidates)
+    # top up with random classes so that small neighborhoods still move something
+    if len(set(freed)) < size:
+        others = list(profs_classes)
+        rng.shuffle(others)
+        freed.extend(others)
+    # the classes of the overlapping professor come first and are always kept
+    chosen = list(dict.fromkeys(freed))
+    return set(chosen[:max(size, sum(c[0] in clashing for c in chosen))])
+
+
+# serialized timetable model shared by the LNS worker processes
+LNS_MODEL = None
+
+
+def init_lns_worker(model_data):
+    global LNS_MODEL
+    LNS_MODEL = model_data
+
+
+# re-solve one LNS neighborhood: the variables in fixed are set to 1 (the classes outside of the
+# neighborhood keep their time slot), hint is the current slot of the freed classes
+# return the variables among candidates set to 1, or None if no solution was found in time
+def solve_neighborhood(fixed, hint, candidates, time_limit, seed):
+    model = cp_model.CpModel()
+    model.Proto().ParseFromString(LNS_MODEL)
+    for index in fixed:
+        model.Add(model.GetBoolVarFromProtoIndex(index) == 1)
+    for index in hint:
+        model.AddHint(model.GetBoolVarFromProtoIndex(index), 1)
+    solver = cp_model.CpSolver()
+    solver.parameters.max_time_in_seconds = time_limit
+    solver.parameters.num_search_workers = 1
+    solver.parameters.random_seed = seed
+    status = solver.Solve(model)
+    if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        return None
+    solution = solver.ResponseProto().solution
+    return [index for index in candidates if solution[index]]
+
+
+# heuristic timetable for one semester with large neighborhood search, for instances too large to solve
+# exactly. it starts from greedy_timetable, then repeatedly frees neighborhood_size classes and re-solves
+# them in the timetable model with the other classes fixed, neighborhood_time_limit seconds each.
+# each round solves one neighborhood per process and keeps the best result.
+# it runs for settings.time_limit seconds (LNS_TIME_LIMIT if not set), or until LNS_PATIENCE rounds in a row
+# don't improve the timetable. return the timetable like get_semester_timetable
+# minimal_change, symmetry_breaking and weights are those of create_timetable_model, with minimal_change
+# the classes moved from previous_slots are counted after the timetable objective
+def lns_timetable(profs_classes, professors, sections, times, conflict_encoding='occupancy', settings=None,
+                  conflict_index=None, previous_slots=None, processes=1, neighborhood_size=LNS_NEIGHBORHOOD_SIZE,
+                  neighborhood_time_limit=LNS_NEIGHBORHOOD_TIME_LIMIT, minimal_change=False, symmetry_breaking=True,
+                  weights=None):
+    if not profs_classes:
+        return []
+    if conflict_index is None:
+        conflict_index = ConflictIndex(times)
+    if settings is None:
+        settings = SolverSettings()
+    start = time.time()
+    deadline = start + (settings.time_limit if settings.time_limit is not None else LNS_TIME_LIMIT)
+    rng = random.Random(settings.random_seed)
+    professor_by_id = {professor.id: professor for professor in professors.values()}
+    section_by_id = {section.id: section for section in sections.values()}
+    if weights is None:
+        weights = timetable_weights(profs_classes, times, conflict_index)
+    # the model orders the slots of interchangeable classes unless it counts moved classes
+    symmetry_breaking = symmetry_breaking and not minimal_change
+    changed_from = previous_slots if minimal_change else None
+
+    with profile_phase('greedy'):
+        slot_of = greedy_timetable(profs_classes, professor_by_id, section_by_id, times, conflict_index, weights,
+                                   previous_slots)
+        if symmetry_breaking:
+            slot_of = order_symmetric_classes(slot_of, section_by_id)
+        cost = timetable_cost(slot_of, professor_by_id, times, conflict_index, weights, changed_from)
+    with profile_phase('build'):
+        model, time_assign = create_timetable_model(profs_classes, professors, sections, times, conflict_encoding,
+                                                    conflict_index, changed_from, minimal_change, symmetry_breaking,
+                                                    weights=weights)
+        # each neighborhood is hinted with the current timetable instead
+        model.ClearHints()
+    index_of = {key: variable.Index() for key, variable in time_assign.items()}
+    key_of = {index: key for key, index in index_of.items()}
+    model_data = model.Proto().SerializeToString()
+
+    with profile_phase('search'):
+        if processes > 1:
+            pool = process_pool(processes, init_lns_worker, (model_data,))
+        else:
+            init_lns_worker(model_data)
+            pool = contextlib.nullcontext()
+        rounds = 0
+        stalled = 0
+        with pool as executor:
+            while time.time() < deadline and stalled < LNS_PATIENCE:
+                check_cancelled()
+                rounds += 1
+                clashing = clashing_professors(slot_of, conflict_index) if cost[0] else []
+                jobs = []
+                for _ in range(max(processes, 1)):
+                    freed = choose_neighborhood(rng, profs_classes, slot_of, times, conflict_index,
+                                                neighborhood_size, clashing)
+                    fixed = [index_of[(c, slot_of[c])] for c in profs_classes if c not in freed]
+                    hint = [index_of[(c, slot_of[c])] for c in freed]
+                    candidates = [index for (c, _), index in index_of.items() if c in freed]
+                    time_limit = max(min(neighborhood_time_limit, deadline - time.time()), 0.01)
+                    jobs.append((fixed, hint, candidates, time_limit, rng.randrange(2 ** 31)))
+                if executor is not None:
+                    results = pool_results([executor.submit(solve_neighborhood, *job) for job in jobs])
+                else:
+                    results = [solve_neighborhood(*job) for job in jobs]
+
+                best = None
+                for chosen in results:
+                    if chosen is None:
+                        continue
+                    candidate = dict(slot_of)
+                    for index in chosen:
+                        c, t = key_of[index]
+                        candidate[c] = t
+                    candidate_cost = timetable_cost(candidate, professor_by_id, times, conflict_index, weights,
+                                                    changed_from)
+                    if best is None or candidate_cost < best[0]:
+                        best = (candidate_cost, candidate)
+                stalled = 0 if best is not None and best[0] < cost else stalled + 1
+                # equal cost moves are kept too, so the search can leave plateaus
+                if best is not None and best[0] <= cost:
+                    if settings.anytime and best[0] < cost:
+                        print('  LNS round %i: overlaps %i, objective %i, %.2f s' % (
+                            rounds, best[0][0], best[0][1], time.time() - start))
+                    cost, slot_of = best
+
+    if cost[0]:
+        raise InfeasibleError("TIMETABLE IS INFEASIBLE, the LNS didn't find a timetable without overlapping "
+                              'classes for ' + ', '.join(professor_by_id[prof_id].name
+                                                         for prof_id in clashing_professors(slot_of, conflict_index)))
+    return [(c, slot_of[c]) for c in profs_classes]
+
+
 # print the final timetable for one semester
 # professor, class name, start time, end time, weekdays
-def print_semester_timetable(solver, time_assign, profs_classes, times, professors):
-    for c in profs_classes:
-        for t in times:
-            if solver.Value(time_assign[(c, t)]) == 1:
-                if professors[c[0]].prefer_time(t):
-                    print(c[0], c[1], t.start, t.end, t.weekdays, 'Timeframe preferred')
-                else:
-                    print(c[0], c[1], t.start, t.end, t.weekdays, 'Timeframe not preferred')
+def print_semester_timetable(timetable, professors, sections, times):
+    professor_by_id = {professor.id: professor for professor in professors.values()}
+    section_by_id = {section.id: section for section in sections.values()}
+    for (prof_id, section_id), index in timetable:
+        professor = professor_by_id[prof_id]
+        section = section_by_id[section_id]
+        t = times[index]
+        if professor.prefer_time(t):
+            print(professor.name, section.name, t.start, t.end, t.weekdays, 'Timeframe preferred')
+        else:
+            print(professor.name, section.name, t.start, t.end, t.weekdays, 'Timeframe not preferred')
     print()
 
 
-# find more schedules by setting one variable
-# return ones with the optimal objective_value
-def find_all_schedule(model, variables):
-    # find the optimal objective value by solving unrestricted variables first
-    optimal_copy = copy.deepcopy(model)
-    solver = solve_model(optimal_copy)
-    optimal_value = solver.ObjectiveValue()
+# create one model for the course assignment and the timetables of all semesters
+# slot_assign[(p, s, t)]: professor with id 'p' teaches section with id 's' in time slot 't'
+# the score is request_weight per request met + time_weight per preferred time slot
+# - conflict_weight per pair of classes in conflicting time slots of the same semester
+def create_joint_model(professors, sections, semesters, times, conflict_index=None, previous=None,
+                       previous_slots=None, symmetry_breaking=True, request_weight=REQUEST_WEIGHT,
+                       time_weight=PREFERRED_TIME_WEIGHT, conflict_weight=CONFLICT_WEIGHT,
+                       max_units_per_semester=MAX_UNITS_PER_SEMESTER):
+    if conflict_index is None:
+        conflict_index = ConflictIndex(times)
+    # the course assignment part is the same model as the first stage
+    model, classes = create_model(professors, sections, semesters, previous, False, symmetry_breaking,
+                                  max_units_per_semester=max_units_per_semester)
+    professor_by_id = {professor.id: professor for professor in professors.values()}
+    section_by_id = {section.id: section for section in sections.values()}
+
+    slot_assign = {}
+    section_slots = {}  # section id : {time slot index : [variables]}
+    professor_slots = {}  # (professor id, semester) : {time slot index : [variables]}
+    other_times = []
+    for (prof_id, section_id), assigned in classes.items():
+        professor = professor_by_id[prof_id]
+        section = section_by_id[section_id]
+        slots = []
+        for t, time_slot in enumerate(times):
+            if time_slot.lab != section.lab:
+                continue
+            key = (prof_id, section_id, t)
+            slot_assign[key] = model.NewBoolVar('{} teaches {} in timeslot {}'.format(*key))
+            slots.append(slot_assign[key])
+            section_slots.setdefault(section_id, {}).setdefault(t, []).append(slot_assign[key])
+            professor_slots.setdefault((prof_id, section.semester), {}).setdefault(t, []).append(slot_assign[key])
+            if not professor.prefer_time(time_slot):
+                other_times.append(slot_assign[key])
+        # an assigned class gets exactly one time slot, an unassigned one none
+        model.Add(sum(slots) == assigned)
+
+    # a professor teaches at most one class in each group of conflicting time slots
+    for slots in professor_slots.values():
+        for clique in conflict_index.cliques:
+            in_clique = [variable for t in clique for variable in slots.get(t, [])]
+            if len(in_clique) > 1:
+                model.Add(sum(in_clique) <= 1)
+
+    # count the conflicts of every section with the occupancy of the time slots in its semester,
+    # as in the occupancy encoding of the timetable model
+    overlaps = []
+    for semester in semesters:
+        # a section is in a slot with any of its professors
+        slot_literals = {}
+        for s, slots in section_slots.items():
+            if section_by_id[s].semester != semester:
+                continue
+            slot_literals[s] = {}
+            for t, variables in slots.items():
+                if len(variables) == 1:
+                    slot_literals[s][t] = variables[0]
+                else:
+                    slot_literals[s][t] = model.NewBoolVar('section {} in timeslot {}'.format(s, t))
+                    model.Add(slot_literals[s][t] == sum(variables))
+        overlaps.extend(add_occupancy_conflicts(model, slot_literals, conflict_index, len(times),
+                                                semester + ' ').values())
+
+    # classes outside their professor's preferred times are penalized rather than preferred ones rewarded,
+    # so that offering a class nobody requested never raises the objective
+    # every conflicting pair is counted from both of its classes, so the other terms are doubled
+    requests = [variable for (prof_id, section_id), variable in classes.items()
+                if professor_by_id[prof_id].prefers(section_by_id[section_id].course)]
+    model.Maximize(2 * request_weight * cp_model.LinearExpr.Sum(requests)
+                   - 2 * time_weight * cp_model.LinearExpr.Sum(other_times)
+                   - conflict_weight * cp_model.LinearExpr.Sum(overlaps))
+
+    # start the search from the previous time slots, the previous assignment is hinted by create_model
+    if previous_slots:
+        for (prof_id, section_id, t), variable in slot_assign.items():
+            if (prof_id, section_id) in previous_slots:
+                model.AddHint(variable, int(previous_slots[(prof_id, section_id)] == t))
+
+    return model, classes, slot_assign
+
+
+# return the timetables of a joint solve, {semester : [(class tuple, index of the assigned time slot)]}
+def get_joint_timetables(solver, slot_assign, scheduled_classes):
+    slot_of = {(prof_id, section_id): t for prof_id, section_id, t in chosen_keys(solver, slot_assign)}
+    return {semester: [(c, slot_of[c]) for c in profs_classes]
+            for semester, profs_classes in scheduled_classes.items()}
+
+
+# count the requests met, the preferred time slots, the conflicting pairs of classes and the classes
+# offered of a schedule
+def evaluate_schedule(professors, sections, times, scheduled_classes, timetables, conflict_index=None):
+    if conflict_index is None:
+        conflict_index = ConflictIndex(times)
+    professor_by_id = {professor.id: professor for professor in professors.values()}
+    section_by_id = {section.id: section for section in sections.values()}
+    requests_met = sum(professor_by_id[prof_id].prefers(section_by_id[section_id].course)
+                       for profs_classes in scheduled_classes.values()
+                       for prof_id, section_id in profs_classes)
+    classes = sum(len(profs_classes) for profs_classes in scheduled_classes.values())
+    preferred_times = 0
+    conflicts = 0
+    for timetable in timetables.values():
+        for i, ((prof_id, _), t) in enumerate(timetable):
+            if professor_by_id[prof_id].prefer_time(times[t]):
+                preferred_times += 1
+            for _, t2 in timetable[i + 1:]:
+                if conflict_index.conflict(t, t2):
+                    conflicts += 1
+    return requests_met, preferred_times, conflicts, classes
+
+
+# weighted score of a schedule, the objective of the joint model
+# classes outside the preferred times of their professor cost time_weight each
+def schedule_score(requests_met, preferred_times, conflicts, classes, request_weight=REQUEST_WEIGHT,
+                   time_weight=PREFERRED_TIME_WEIGHT, conflict_weight=CONFLICT_WEIGHT):
+    return request_weight * requests_met - time_weight * (classes - preferred_times) - conflict_weight * conflicts
+
+
+# print one row per run, rows are (name, (requests met, preferred time slots, conflicts, classes), seconds)
+# runs without a schedule have None instead of the counts
+def print_comparison(rows, title='pipeline'):
+    width = max([len(title)] + [len(name) for name, _, _ in rows])
+    print('{:<{}} {:>7} {:>12} {:>15} {:>9} {:>7} {:>9}'.format(
+        title, width, 'classes', 'requests met', 'preferred times', 'conflicts', 'score', 'time (s)'))
+    for name, metrics, seconds in rows:
+        if metrics is None:
+            print('{:<{}} {:>54} {:>9.2f}'.format(name, width, 'infeasible', seconds))
+            continue
+        requests_met, preferred_times, conflicts, classes = metrics
+        print('{:<{}} {:>7} {:>12} {:>15} {:>9} {:>7} {:>9.2f}'.format(
+            name, width, classes, requests_met, preferred_times, conflicts,
+            schedule_score(*metrics), seconds))
+    print()
+
 
+# records the distinct solutions found during a search
+# a solution record is the tuple of positions of the variables set to 1
+class SolutionCollector(cp_model.CpSolverSolutionCallback):
+
+    def __init__(self, literals, seen, max_solutions=None, deadline=None):
+        cp_model.CpSolverSolutionCallback.__init__(self)
+        self.literals = literals  # list of (position, variable)
+        self.seen = seen
+        self.max_solutions = max_solutions
+        self.deadline = deadline
+        self.solutions = []
+        self.duplicate = False
+
+    def OnSolutionCallback(self):
+        record = tuple(position for position, literal in self.literals if self.BooleanValue(literal))
+        if record in self.seen:
+            # only other variables changed, stop so the caller can cut the found solutions off
+            self.duplicate = True
+            self.StopSearch()
+            return
+        self.seen.add(record)
+        self.solutions.append(record)
+        if self.max_solutions is not None and len(self.seen) >= self.max_solutions:
+            self.StopSearch()
+        elif self.deadline is not None and time.time() >= self.deadline:
+            self.StopSearch()
+
+
+# return a copy of the model where the objective is replaced by a constraint
+# fixing the objective to the given value
+def fix_objective(model, value):
+    fixed = model.Clone()
+    objective = fixed.Proto().objective
+    scaling = objective.scaling_factor or 1
+    target = int(round(value / scaling - objective.offset))
+    constraint = fixed.Proto().constraints.add()
+    constraint.linear.vars.extend(objective.vars)
+    constraint.linear.coeffs.extend(objective.coeffs)
+    constraint.linear.domain.extend([target, target])
+    fixed.Proto().ClearField('objective')
+    return fixed
+
+
+# stream the distinct solutions of a model in one search
+# variables : list of (position, index of the variable in the model proto)
+# if the search returns a solution again (other variables changed),
+# add no-good cuts for the solutions found so far and search again
+def enumerate_solutions(model, variables, max_solutions=None, deadline=None):
+    literals = [(position, model.GetBoolVarFromProtoIndex(index)) for position, index in variables]
+    seen = set()
     solutions = []
-    for var in variables:
-        copies = copy.deepcopy(model)
-        copies.Add(variables[var] == 1)
-        # skip if it's infeasible
-        try:
-            solver = solve_model(copies)
-        except AssertionError as e:
-            continue
-        if solver.ObjectiveValue() == optimal_value:
-            solutions.append(solver)
+    while True:
+        solver = cp_model.CpSolver()
+        solver.parameters.enumerate_all_solutions = True
+        solver.parameters.num_search_workers = 1
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            solver.parameters.max_time_in_seconds = remaining
+        collector = SolutionCollector(literals, seen, max_solutions, deadline)
+        solver.Solve(model, collector)
+        solutions.extend(collector.solutions)
+        if not collector.duplicate:
+            break
+        if max_solutions is not None and len(solutions) >= max_solutions:
+            break
+        for record in collector.solutions:
+            chosen = set(record)
+            model.AddBoolOr([literal.Not() if position in chosen else literal
+                             for position, literal in literals])
     return solutions
 
 
-def main(sheets_source):
-    # schedule sections and print the result
-    if sheets_source.startswith('http'):
-        sheets = read_ggsheets(sheets_source)
+# serialized model shared by the enumeration worker processes
+ENUMERATION_MODEL = None
+
+
+def init_enumeration_worker(model_data):
+    global ENUMERATION_MODEL
+    ENUMERATION_MODEL = model_data
+
+
+# enumerate the solutions where the first fixed variable is 1 and the others are 0
+def enumerate_partition(variables, fixed_ones, fixed_zeros, max_solutions, deadline):
+    model = cp_model.CpModel()
+    model.Proto().ParseFromString(ENUMERATION_MODEL)
+    for index in fixed_ones:
+        model.Add(model.GetBoolVarFromProtoIndex(index) == 1)
+    for index in fixed_zeros:
+        model.Add(model.GetBoolVarFromProtoIndex(index) == 0)
+    return enumerate_solutions(model, variables, max_solutions, deadline)
+
+
+# find the schedules with the optimal objective value
+# variables : {key : BoolVar}, solutions are compared on these variables only
+# return a list of solutions, each is the tuple of keys of the variables set to 1
+# (the (professor id, section id) pairs assigned for create_model)
+# stop after max_solutions solutions or time_limit seconds, which include finding the optimal value
+# the list is empty if the optimal value isn't proven within time_limit
+# with more than one process, the search space is split into disjoint partitions
+# on the first variables and each partition is enumerated in a process pool
+def find_all_schedule(model, variables, max_solutions=None, time_limit=None, processes=1):
+    deadline = time.time() + time_limit if time_limit is not None else None
+    # find the optimal objective value by solving unrestricted variables first
+    try:
+        solver = solve_model(model, SolverSettings(time_limit=time_limit))
+        status = solver.StatusName()
+    except NoSolutionError:
+        status = 'UNKNOWN'
+    if status != 'OPTIMAL':
+        # enumerating with a value that isn't proven optimal would return worse schedules
+        print('The optimal value is not proven within %s s, no schedules enumerated' % time_limit)
+        return []
+    fixed = fix_objective(model, solver.ObjectiveValue())
+
+    keys = list(variables)
+    positions = [(position, variables[key].Index()) for position, key in enumerate(keys)]
+    if processes <= 1 or not keys:
+        records = enumerate_solutions(fixed, positions, max_solutions, deadline)
+    else:
+        # partition i: variable i is 1 and the variables before it are 0, last partition: all are 0
+        split = [index for _, index in positions[:2 * processes]]
+        partitions = [([index], split[:i]) for i, index in enumerate(split)]
+        partitions.append(([], split))
+        records = []
+        with process_pool(processes, init_enumeration_worker, (fixed.Proto().SerializeToString(),)) as executor:
+            futures = [executor.submit(enumerate_partition, positions, ones, zeros, max_solutions, deadline)
+                       for ones, zeros in partitions]
+            for partition_records in pool_results(futures):
+                records.extend(partition_records)
+        if max_solutions is not None:
+            records = records[:max_solutions]
+
+    return [tuple(keys[position] for position in record) for record in records]
+
+
+# save a schedule to a json file so that the next run can start from it
+# professors and sections are saved by name and time slots by their key, since ids change when the sheets are edited
+def save_schedule(file_name, professors, sections, times, scheduled_classes, timetables):
+    with open(file_name, 'w') as f:
+        json.dump(schedule_record(professors, sections, times, scheduled_classes, timetables), f, indent=1)
+
+
+# the content of a schedule file, {'classes': [[professor, section]], 'timeslots': [[professor, section, slot]]}
+def schedule_record(professors, sections, times, scheduled_classes, timetables):
+    professor_by_id = {professor.id: professor for professor in professors.values()}
+    section_by_id = {section.id: section for section in sections.values()}
+    classes = [
+        [professor_by_id[prof_id].name, section_by_id[section_id].name]
+        for profs_classes in scheduled_classes.values()
+        for prof_id, section_id in profs_classes
+    ]
+    slots = [
+        [professor_by_id[prof_id].name, section_by_id[section_id].name, times[t].key()]
+        for timetable in timetables.values()
+        for (prof_id, section_id), t in timetable
+    ]
+    return {'classes': classes, 'timeslots': slots}
+
+
+# load a schedule saved by save_schedule, matched against the current input
+# return the set of (professor id, section id) and {(professor id, section id) : time slot index}
+# entries for professors, sections or time slots that no longer exist are skipped
+def load_schedule(file_name, professors, sections, times):
+    with open(file_name) as f:
+        return match_schedule(json.load(f), professors, sections, times)
+
+
+# match the content of a schedule file against the current input, like load_schedule
+def match_schedule(data, professors, sections, times):
+    time_by_key = {t.key(): index for index, t in enumerate(times)}
+
+    previous = set()
+    for prof_name, section_name in data['classes']:
+        if prof_name in professors and section_name in sections:
+            previous.add((professors[prof_name].id, sections[section_name].id))
+    previous_slots = {}
+    for prof_name, section_name, key in data['timeslots']:
+        if prof_name in professors and section_name in sections and key in time_by_key:
+            previous_slots[(professors[prof_name].id, sections[section_name].id)] = time_by_key[key]
+    return previous, previous_slots
+
+
+# table of a schedule with one row per class, sorted by semester, professor and section
+def schedule_table(professors, sections, times, scheduled_classes, timetables):
+    professor_by_id = {professor.id: professor for professor in professors.values()}
+    section_by_id = {section.id: section for section in sections.values()}
+    rows = []
+    for semester, timetable in timetables.items():
+        for (prof_id, section_id), t in timetable:
+            professor = professor_by_id[prof_id]
+            section = section_by_id[section_id]
+            time_slot = times[t]
+            rows.append({
+                'Semester': semester,
+                'Professor': professor.name,
+                'Section': section.name,
+                'Course': section.course,
+                'Unit': section.units,
+                'Requested': int(professor.prefers(section.course)),
+                'Days': time_slot.days_of_week,
+                'START TIME': str(time_slot.start),
+                'END TIME': str(time_slot.end),
+                'Lab': int(time_slot.lab),
+                'Preferred time': int(professor.prefer_time(time_slot)),
+            })
+    table = pd.DataFrame(rows, columns=SCHEDULE_COLUMNS)
+    semester_order = {semester: i for i, semester in enumerate(scheduled_classes)}
+    return table.sort_values(['Semester', 'Professor', 'Section'],
+                             key=lambda column: column.map(semester_order) if column.name == 'Semester' else column,
+                             kind='stable').reset_index(drop=True)
+
+
+# write a schedule table to a csv, json or excel file, chosen by the file extension
+def export_schedule(table, file_name):
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.csv':
+        table.to_csv(file_name, index=False)
+    elif extension == '.json':
+        table.to_json(file_name, orient='records', indent=1)
+    elif extension == '.xlsx':
+        table.to_excel(file_name, sheet_name=SCHEDULE_SHEET, index=False)
     else:
-        sheets = read_excel(sheets_source)
-    semesters, sections, professors, times = read_input(sheets)
-    model, classes = create_model(professors, sections, semesters)
-    solver = solve_model(model)
-    print_results(solver, classes, professors, sections, semesters)
+        raise ValueError('unknown export format', file_name, 'use one of', EXPORT_FORMATS)
+
+
+# write a schedule table to a tab of the spreadsheet, the old content of the tab is cleared
+# and the whole table is written in one batch update
+def write_schedule_sheet(spreadsheet, table, sheet_name=SCHEDULE_SHEET):
+    values = [list(table.columns)] + table.astype(object).values.tolist()
+    if sheet_name in [worksheet.title for worksheet in spreadsheet.worksheets()]:
+        spreadsheet.values_clear("'{}'".format(sheet_name))
+    else:
+        spreadsheet.add_worksheet(sheet_name, rows=len(values), cols=len(table.columns))
+    spreadsheet.values_batch_update(body={
+        'valueInputOption': 'RAW',
+        'data': [{'range': "'{}'!A1".format(sheet_name), 'values': values}],
+    })
+
+
+# solve the course assignment, then the timetable of each semester
+# return the solver of the assignment, its classes, the scheduled classes and the timetables
+def solve_two_stage(professors, sections, semesters, times, conflict_encoding='occupancy', processes=1,
+                    conflict_index=None, previous=None, previous_slots=None, minimal_change=False, settings=None,
+                    symmetry_breaking=True, engine='exact', compress=True,
+                    max_units_per_semester=MAX_UNITS_PER_SEMESTER):
+    with profile_phase('build'):
+        model, classes = create_model(professors, sections, semesters, previous, minimal_change,
+                                      symmetry_breaking, max_units_per_semester=max_units_per_semester)
+    try:
+        with profile_phase('solve'):
+            solver = solve_model(model, settings)
+    except InfeasibleError:
+        # build the model again with assumptions to find out which constraints conflict
+        assumptions = {}
+        model, _ = create_model(professors, sections, semesters, previous, minimal_change, symmetry_breaking,
+                                assumptions, max_units_per_semester)
+        core = explain_infeasibility(model, assumptions, settings)
+        raise InfeasibleError('PROBLEM IS INFEASIBLE, conflicting constraints: ' + '; '.join(core))
 
     # timetable scheduling for each semester
-    scheduled_classes = get_semester_schedule(solver, classes, professors, sections, semesters)
+    with profile_phase('extract'):
+        scheduled_classes = get_semester_schedule(solver, classes, professors, sections, semesters)
+    with profile_phase('timetables'):
+        timetables = solve_timetables(scheduled_classes, semesters, professors, sections, times,
+                                      conflict_encoding, processes, conflict_index, previous_slots, minimal_change,
+                                      settings, symmetry_breaking, engine, compress)
+    return solver, classes, scheduled_classes, timetables
+
+
+# solve the course assignment and the timetables in one model, same return values as solve_two_stage
+def solve_joint(professors, sections, semesters, times, conflict_index=None, previous=None, previous_slots=None,
+                settings=None, symmetry_breaking=True, max_units_per_semester=MAX_UNITS_PER_SEMESTER):
+    with profile_phase('build'):
+        model, classes, slot_assign = create_joint_model(professors, sections, semesters, times, conflict_index,
+                                                         previous, previous_slots, symmetry_breaking,
+                                                         max_units_per_semester=max_units_per_semester)
+    with profile_phase('solve'):
+        solver = solve_model(model, settings)
+    with profile_phase('extract'):
+        scheduled_classes = get_semester_schedule(solver, classes, professors, sections, semesters)
+        timetables = get_joint_timetables(solver, slot_assign, scheduled_classes)
+    return solver, classes, scheduled_classes, timetables
+
+
+# apply the changes of a what-if scenario to the parsed input, return new professors and sections dicts
+# the input isn't modified. a scenario is a dict with any of:
+#   'sabbatical': [professor name], professors who don't teach
+#   'max_units': {professor name : MaxUnit}
+#   'add_sections': [{'course': name, 'semester': name, 'count': n, 'must_offer': bool}], extra sections
+#   'max_units_per_semester': n, replaces MAX_UNITS_PER_SEMESTER (passed to the solve by run_scenario)
+def apply_scenario(professors, sections, semesters, scenario):
+    professors = dict(professors)
+    sections = dict(sections)
+    for name in scenario.get('sabbatical', []):
+        if name not in professors:
+            raise ValueError('unknown professor in scenario', name)
+        del professors[name]
+    for name, max_units in scenario.get('max_units', {}).items():
+        if name not in professors:
+            raise ValueError('unknown professor in scenario', name)
+        professors[name] = copy.copy(professors[name])
+        professors[name].max_units = max_units
+
+    next_id = max((section.id for section in sections.values()), default=-1) + 1
+    for extra in scenario.get('add_sections', []):
+        course, semester = extra['course'], extra['semester']
+        if semester not in semesters:
+            raise ValueError('unknown semester in scenario', semester)
+        # units and lab are the same for all sections of a course
+        course_sections = [section for section in sections.values() if section.course == course]
+        if not course_sections:
+            raise ValueError('no sections of the course to copy in scenario', course)
+        number = sum(section.semester == semester for section in course_sections)
+        for i in range(extra.get('count', 1)):
+            section = Section(course, number + i, course_sections[0].units, semester,
+                              must_offer=int(extra.get('must_offer', False)), lab=course_sections[0].lab,
+                              id=next_id)
+            sections[section.name] = section
+            next_id += 1
+    return professors, sections
+
+
+# solve one scenario with the two-stage pipeline
+# return (name, (requests met, preferred time slots, conflicts, classes) or None if infeasible, seconds)
+def run_scenario(name, scenario, professors, sections, semesters, times, conflict_encoding='occupancy',
+                 conflict_index=None, settings=None, symmetry_breaking=True):
+    start = time.time()
+    max_units_per_semester = scenario.get('max_units_per_semester', MAX_UNITS_PER_SEMESTER)
+    try:
+        professors, sections = apply_scenario(professors, sections, semesters, scenario)
+        check_feasibility(professors, sections, semesters, times, max_units_per_semester)
+        _, _, scheduled_classes, timetables = solve_two_stage(
+            professors, sections, semesters, times, conflict_encoding, conflict_index=conflict_index,
+            settings=settings, symmetry_breaking=symmetry_breaking, max_units_per_semester=max_units_per_semester)
+        metrics = evaluate_schedule(professors, sections, times, scheduled_classes, timetables, conflict_index)
+    except (InfeasibleError, ValueError) as error:
+        print('{}: {}'.format(name, error))
+        metrics = None
+    return name, metrics, time.time() - start
+
+
+# solve the base input and each scenario of a json file (a list of scenario dicts with a 'name',
+# see apply_scenario) in a process pool, the input is read once and the scenarios share it
+# return the rows of print_comparison
+def run_scenarios(scenarios, professors, sections, semesters, times, conflict_encoding='occupancy',
+                  processes=1, conflict_index=None, settings=None, symmetry_breaking=True):
+    if conflict_index is None:
+        conflict_index = ConflictIndex(times)
+    if settings is None:
+        settings = SolverSettings()
+    scenarios = [{'name': 'base'}] + list(scenarios)
+    if processes <= 1:
+        return [run_scenario(scenario['name'], scenario, professors, sections, semesters, times,
+                             conflict_encoding, conflict_index, settings, symmetry_breaking)
+                for scenario in scenarios]
+    processes = min(processes, len(scenarios))
+    settings = settings.split(processes)
+    with process_pool(processes) as executor:
+        futures = [executor.submit(run_scenario, scenario['name'], scenario, professors, sections, semesters,
+                                   times, conflict_encoding, conflict_index, settings, symmetry_breaking)
+                   for scenario in scenarios]
+        return pool_results(futures)
+
+
+# schedule_file is a json file with the last schedule, it is used as a starting point if it exists
+# and then replaced by the new schedule
+# settings are the SolverSettings used for every solve
+# mode is 'two-stage', 'joint' or 'compare', which runs both and prints their scores and runtimes
+# engine is 'exact' or 'lns', how the timetables of the two-stage pipeline are solved
+# cache_dir is the directory of the cache of parsed input tabs, None to always parse the input
+# scenarios_file is a json file of what-if scenarios, which are solved and compared instead
+# export_file is a csv, json or excel file for the schedule table,
+# with write_sheet the table is also written to the Schedule tab of the source
+# compress merges equivalent time slots in the exact timetable models
+def main(sheets_source, conflict_encoding='occupancy', processes=1, schedule_file=None, minimal_change=False,
+         settings=None, symmetry_breaking=True, mode='two-stage', engine='exact', cache_dir=CACHE_DIR,
+         scenarios_file=None, export_file=None, write_sheet=False, compress=True):
+    # check the output options before the input is read and solved
+    if export_file is not None and os.path.splitext(export_file)[1].lower() not in EXPORT_FORMATS:
+        raise ValueError('unknown export format', export_file, 'use one of', EXPORT_FORMATS)
+    if write_sheet and not sheets_source.startswith('http'):
+        # saving a workbook with pandas drops the values of its formulas, so excel input is only exported
+        raise ValueError('--write-sheet needs a google sheets source, use --export for excel files')
+    # schedule sections and print the result
+    with profile_phase('load'):
+        if sheets_source.startswith('http'):
+            sheets = read_ggsheets(sheets_source, cache_dir=cache_dir)
+        else:
+            sheets = read_excel(sheets_source, cache_dir)
+    with profile_phase('parse'):
+        semesters, sections, professors, times = read_input(sheets)
+    with profile_phase('conflict index'):
+        conflict_index = ConflictIndex(times)
+    if scenarios_file is not None:
+        with open(scenarios_file) as f:
+            scenarios = json.load(f)
+        rows = run_scenarios(scenarios, professors, sections, semesters, times, conflict_encoding, processes,
+                             conflict_index, settings, symmetry_breaking)
+        print_comparison(rows, 'scenario')
+        return
+
+    previous, previous_slots = None, None
+    if schedule_file is not None and os.path.exists(schedule_file):
+        previous, previous_slots = load_schedule(schedule_file, professors, sections, times)
+
+    if mode == 'compare':
+        rows = []
+        start = time.time()
+        _, _, scheduled_classes, timetables = solve_two_stage(
+            professors, sections, semesters, times, conflict_encoding, processes, conflict_index, previous,
+            previous_slots, minimal_change, settings, symmetry_breaking, engine, compress)
+        metrics = evaluate_schedule(professors, sections, times, scheduled_classes, timetables, conflict_index)
+        rows.append(('two-stage' if engine == 'exact' else 'lns', metrics, time.time() - start))
+        start = time.time()
+        _, _, scheduled_classes, timetables = solve_joint(
+            professors, sections, semesters, times, conflict_index, previous, previous_slots, settings,
+            symmetry_breaking)
+        rows.append(('joint', evaluate_schedule(professors, sections, times, scheduled_classes, timetables,
+                                                conflict_index), time.time() - start))
+        print_comparison(rows)
+        return
+
+    if mode == 'joint':
+        with profile_phase('joint'):
+            solver, classes, scheduled_classes, timetables = solve_joint(
+                professors, sections, semesters, times, conflict_index, previous, previous_slots, settings,
+                symmetry_breaking)
+    elif mode == 'two-stage':
+        with profile_phase('two-stage'):
+            solver, classes, scheduled_classes, timetables = solve_two_stage(
+                professors, sections, semesters, times, conflict_encoding, processes, conflict_index, previous,
+                previous_slots, minimal_change, settings, symmetry_breaking, engine, compress)
+    else:
+        raise ValueError('unknown mode', mode)
+    with profile_phase('print'):
+        print_results(solver, classes, professors, sections, semesters)
+        for semester in semesters:
+            print_semester_timetable(timetables[semester], professors, sections, times)
 
-    for semester in semesters:
-        profs_classes = scheduled_classes[semester]  # list of (professor.name, section.name)
-        model, time_assign = create_timetable_model(profs_classes, professors, sections, times)
-        solver = solve_model(model)
-        print_semester_timetable(solver, time_assign, profs_classes, times, professors)
+    if schedule_file is not None:
+        with profile_phase('save'):
+            save_schedule(schedule_file, professors, sections, times, scheduled_classes, timetables)
+    if export_file is not None or write_sheet:
+        with profile_phase('export'):
+            table = schedule_table(professors, sections, times, scheduled_classes, timetables)
+            if export_file is not None:
+                export_schedule(table, export_file)
+            if write_sheet:
+                write_schedule_sheet(open_spreadsheet(sheets_source), table)
 
 
 if __name__ == '__main__':
-    main(SHEETS_URL)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Create course schedules for a department.')
+    parser.add_argument('source', nargs='?', default=SHEETS_URL,
+                        help='google sheets link or excel file name (default: SHEETS_URL)')
+    parser.add_argument('--conflict-encoding', choices=['occupancy', 'pairwise'], default='occupancy',
+                        help='how time conflicts are modeled in the timetable scheduling')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of processes solving the semester timetables in parallel')
+    parser.add_argument('--schedule-file',
+                        help='json file with the last schedule, used as a starting point and updated after solving')
+    parser.add_argument('--minimal-change', action='store_true',
+                        help='prefer the schedule closest to the one in --schedule-file among the best ones')
+    parser.add_argument('--time-limit', type=float,
+                        help='time limit in seconds for each solve, the best schedule found by then is used')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of CP-SAT search workers (default: solver default)')
+    parser.add_argument('--relative-gap', type=float,
+                        help='stop once the objective is proven within this fraction of the best bound')
+    parser.add_argument('--seed', type=int, help='random seed of the solver')
+    parser.add_argument('--log', action='store_true', help='print the CP-SAT search log')
+    parser.add_argument('--anytime', action='store_true', help='print every improving solution as it is found')
+    parser.add_argument('--no-symmetry-breaking', dest='symmetry_breaking', action='store_false',
+                        help="don't order interchangeable sections of the same course")
+    parser.add_argument('--mode', choices=['two-stage', 'joint', 'compare'], default='two-stage',
+                        help='solve the assignment and the timetables one after the other, in one model, '
+                             'or both and compare them')
+    parser.add_argument('--engine', choices=['exact', 'lns'], default='exact',
+                        help='solve the timetables exactly or with large neighborhood search (for large inputs)')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='parse the input again instead of using the cached tabs in ' + CACHE_DIR)
+    parser.add_argument('--scenarios',
+                        help='json file of what-if scenarios to solve in --processes processes and compare')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='print the time of each phase and write timings, model sizes and search statistics '
+                             'to a json file')
+    parser.add_argument('--cprofile', metavar='FILE', help='write cProfile statistics of the run to a file')
+    parser.add_argument('--export', metavar='FILE',
+                        help='write the schedule as a table to a .csv, .json or .xlsx file')
+    parser.add_argument('--write-sheet', action='store_true',
+                        help='write the schedule table to the Schedule tab of the google sheets source')
+    parser.add_argument('--no-slot-compression', dest='compress', action='store_false',
+                        help="don't merge equivalent time slots in the timetable models")
+    args = parser.parse_args()
+    settings = SolverSettings(args.time_limit, args.workers, args.relative_gap, args.seed, args.log, args.anytime)
+    if args.profile:
+        start_profiling()
+    profiler = cProfile.Profile() if args.cprofile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        main(args.source, args.conflict_encoding, args.processes, args.schedule_file, args.minimal_change,
+             settings, args.symmetry_breaking, args.mode, args.engine, CACHE_DIR if args.cache else None,
+             args.scenarios, args.export, args.write_sheet, args.compress)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+        if args.profile:
+            stop_profiling(args.profile)
\ No newline at end of file
@@ -0,0 +1,486 @@
+import argparse
+import collections
+import hashlib
+import http.server
+import itertools
+import json
+import os
+import socketserver
+import threading
+import time
+
+from ortools.sat.python import cp_model
+
+import schedule
+
+# parsed inputs kept in memory, the least recently used ones are dropped first
+MAX_CACHED_INPUTS = 8
+DEFAULT_PORT = 8765
+# values of the string options of the requests
+REQUEST_CHOICES = {
+    'mode': ('two-stage', 'joint'),
+    'engine': ('exact', 'lns'),
+    'conflict_encoding': ('occupancy', 'pairwise'),
+}
+
+
+# a solve stopped by a cancel request
+class JobCancelled(Exception):
+    pass
+
+
+# parsed input with its conflict index and the models built from it, the assignment models are kept
+# by their options and cloned for each solve, timetables are kept by their semester classes and options
+class InputEntry:
+
+    def __init__(self, key, sheets):
+        self.key = key
+        self.semesters, self.sections, self.professors, self.times = schedule.read_input(sheets)
+        self.conflict_index = schedule.ConflictIndex(self.times)
+        self.models = {}  # symmetry breaking : (model, classes)
+        self.timetables = {}  # (semester, classes, options) : timetable
+        self.lock = threading.Lock()
+
+    def assignment_model(self, symmetry_breaking=True):
+        with self.lock:
+            if symmetry_breaking not in self.models:
+                self.models[symmetry_breaking] = schedule.create_model(self.professors, self.sections,
+                                                                       self.semesters,
+                                                                       symmetry_breaking=symmetry_breaking)
+            model, classes = self.models[symmetry_breaking]
+            return model.Clone(), classes
+
+
+# value of a field of a json request, checked against the types it may have (a bool isn't a number)
+def request_field(request, name, types, default=None):
+    value = request.get(name, default)
+    if value is not None and (not isinstance(value, types) or isinstance(value, bool) and bool not in types):
+        raise ValueError('invalid {}: {!r}'.format(name, value))
+    return value
+
+
+# check the scenarios of a request, see schedule.apply_scenario
+def check_scenarios(scenarios):
+    for scenario in scenarios:
+        if not isinstance(scenario, dict) or not isinstance(scenario.get('name'), str):
+            raise ValueError('every scenario needs a name')
+        for name in request_field(scenario, 'sabbatical', (list,), []):
+            if not isinstance(name, str):
+                raise ValueError('invalid sabbatical: {!r}'.format(name))
+        for name, max_units in request_field(scenario, 'max_units', (dict,), {}).items():
+            if not isinstance(max_units, int) or isinstance(max_units, bool):
+                raise ValueError('invalid max_units of {}: {!r}'.format(name, max_units))
+        for extra in request_field(scenario, 'add_sections', (list,), []):
+            if not isinstance(extra, dict) or 'course' not in extra or 'semester' not in extra:
+                raise ValueError('added sections need a course and a semester')
+            request_field(extra, 'course', (str,))
+            request_field(extra, 'semester', (str,))
+            request_field(extra, 'count', (int,))
+            request_field(extra, 'must_offer', (bool, int))
+        request_field(scenario, 'max_units_per_semester', (int,))
+
+
+# parsed inputs by the hash of their content (excel files) or their last modification (google sheets)
+class InputCache:
+
+    def __init__(self, max_entries=MAX_CACHED_INPUTS):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    # return the entry of a source and whether it was already in memory
+    def get(self, source):
+        if source.startswith('http'):
+            key = schedule.sheets_cache_key(schedule.open_spreadsheet(source))
+        else:
+            with open(source, 'rb') as f:
+                key = 'excel ' + hashlib.sha256(f.read()).hexdigest()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key], True
+        if source.startswith('http'):
+            sheets = schedule.read_ggsheets(source)
+        else:
+            sheets = schedule.read_excel(source)
+        entry = InputEntry(key, sheets)
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry, False
+
+
+# streams the improving solutions of a solve to the job events and stops the search on cancel
+class JobProgress(cp_model.CpSolverSolutionCallback):
+
+    def __init__(self, job, callback=None):
+        cp_model.CpSolverSolutionCallback.__init__(self)
+        self.job = job
+        self.callback = callback
+
+    def OnSolutionCallback(self):
+        self.job.emit('solution', objective=self.ObjectiveValue(), bound=self.BestObjectiveBound(),
+                      seconds=self.WallTime())
+        if self.callback is not None:
+            self.callback.OnSolutionCallback()
+        if self.job.cancelled:
+            self.StopSearch()
+
+
+# a request running in the service: its events, its result and its running solves
+# it is the solve listener of its thread (see schedule.SOLVE_LISTENER)
+class Job:
+
+    def __init__(self, job_id, kind, request):
+        self.id = job_id
+        self.kind = kind
+        self.request = request
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.events = []
+        self.solvers = set()
+        self.started = time.time()
+        self.condition = threading.Condition()
+
+    def emit(self, event, **fields):
+        with self.condition:
+            self.events.append(dict(event=event, job=self.id, time=round(time.time() - self.started, 3), **fields))
+            self.condition.notify_all()
+
+    # called by schedule.solve_model around each solve of the job's thread
+    def start(self, solver, callback):
+        with self.condition:
+            if self.cancelled:
+                raise JobCancelled()
+            self.solvers.add(solver)
+        return JobProgress(self, callback)
+
+    def finish(self, solver):
+        with self.condition:
+            self.solvers.discard(solver)
+            if self.cancelled:
+                raise JobCancelled()
+
+    # called by schedule.check_cancelled, between LNS rounds and while waiting for solves in other processes
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            for solver in self.solvers:
+                solver.StopSearch()
+
+    def done(self, status, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.emit(status, result=result, error=error)
+        with self.condition:
+            self.status = status
+
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    # yield the events as they come until the job is finished
+    def stream(self):
+        position = 0
+        while True:
+            with self.condition:
+                while position == len(self.events) and not self.finished():
+                    self.condition.wait()
+                events = self.events[position:]
+                position = len(self.events)
+                finished = self.finished()
+            yield from events
+            if finished and position == len(self.events):
+                return
+
+    def summary(self):
+        return {'job': self.id, 'kind': self.kind, 'status': self.status, 'result': self.result,
+                'error': self.error, 'events': len(self.events)}
+
+
+# runs the solve, re-solve and scenario requests, each in its own thread, on the cached inputs
+# the last schedule of each source is kept for re-solves
+class SchedulingService:
+
+    def __init__(self, max_inputs=MAX_CACHED_INPUTS):
+        self.inputs = InputCache(max_inputs)
+        self.jobs = {}
+        self.last_schedules = {}  # source : schedule record
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    # raise ValueError for an unknown request or invalid fields, before the job is created
+    def submit(self, kind, request):
+        handlers = {'solve': self.solve, 'resolve': self.resolve, 'scenarios': self.scenarios}
+        if kind not in handlers:
+            raise ValueError('unknown request', kind)
+        self.check(kind, request)
+        with self.lock:
+            job = Job(next(self.ids), kind, request)
+            self.jobs[job.id] = job
+        threading.Thread(target=self.run, args=(job, handlers[kind]), daemon=True).start()
+        return job
+
+    def cancel(self, job_id):
+        job = self.jobs[job_id]
+        job.cancel()
+        return job
+
+    def run(self, job, handler):
+        schedule.SOLVE_LISTENER.listener = job
+        job.status = 'running'
+        job.emit('started', kind=job.kind)
+        try:
+            job.done('done', handler(job, job.request))
+        except JobCancelled:
+            job.done('cancelled')
+        except Exception as error:
+            # the job fails, the service keeps running
+            job.done('failed', error='{}: {}'.format(type(error).__name__, error))
+        finally:
+            schedule.SOLVE_LISTENER.listener = None
+
+    def load(self, job, request):
+        entry, cached = self.inputs.get(request.get('source', schedule.EXCEL_NAME))
+        job.emit('input', cached=cached, key=entry.key)
+        return entry
+
+    @classmethod
+    def check(cls, kind, request):
+        if not isinstance(request, dict):
+            raise ValueError('the request must be a json object')
+        request_field(request, 'source', (str,))
+        for name, choices in REQUEST_CHOICES.items():
+            if request_field(request, name, (str,), choices[0]) not in choices:
+                raise ValueError('invalid {}: {!r}'.format(name, request[name]))
+        for name in ('compress', 'symmetry_breaking', 'minimal_change', 'stream', 'wait'):
+            request_field(request, name, (bool,))
+        cls.settings(request)
+        if kind == 'scenarios':
+            request_field(request, 'processes', (int,))
+            check_scenarios(request_field(request, 'scenarios', (list,), []))
+
+    @staticmethod
+    def settings(request):
+        return schedule.SolverSettings(request_field(request, 'time_limit', (int, float)),
+                                       request_field(request, 'workers', (int,), 0),
+                                       request_field(request, 'relative_gap', (int, float)),
+                                       request_field(request, 'seed', (int,)))
+
+    # request: source, mode ('two-stage' or 'joint'), engine, conflict_encoding, time_limit, workers,
+    # relative_gap, seed, symmetry_breaking, compress
+    def solve(self, job, request, previous=None, previous_slots=None, minimal_change=False):
+        entry = self.load(job, request)
+        source = request.get('source', schedule.EXCEL_NAME)
+        settings = self.settings(request)
+        symmetry_breaking = request.get('symmetry_breaking', True)
+        start = time.time()
+        if request.get('mode', 'two-stage') == 'joint':
+            _, _, scheduled_classes, timetables = schedule.solve_joint(
+                entry.professors, entry.sections, entry.semesters, entry.times, entry.conflict_index, previous,
+                previous_slots, settings, symmetry_breaking)
+        elif previous is not None:
+            # the hints change the model, so it is built again
+            _, _, scheduled_classes, timetables = schedule.solve_two_stage(
+                entry.professors, entry.sections, entry.semesters, entry.times,
+                request.get('conflict_encoding', 'occupancy'), 1, entry.conflict_index, previous, previous_slots,
+                minimal_change, settings, symmetry_breaking, request.get('engine', 'exact'),
+                request.get('compress', True))
+        else:
+            scheduled_classes, timetables = self.solve_cached(job, entry, request, settings)
+        metrics = schedule.evaluate_schedule(entry.professors, entry.sections, entry.times, scheduled_classes,
+                                             timetables, entry.conflict_index)
+        self.last_schedules[source] = schedule.schedule_record(entry.professors, entry.sections, entry.times,
+                                                               scheduled_classes, timetables)
+        table = schedule.schedule_table(entry.professors, entry.sections, entry.times, scheduled_classes,
+                                        timetables)
+        return {
+            'requests_met': metrics[0],
+            'preferred_times': metrics[1],
+            'conflicts': metrics[2],
+            'classes': metrics[3],
+            'score': schedule.schedule_score(*metrics),
+            'seconds': time.time() - start,
+            'schedule': json.loads(table.to_json(orient='records')),
+        }
+
+    # two-stage solve on the cached assignment model, the timetables of unchanged semesters are reused
+    def solve_cached(self, job, entry, request, settings):
+        symmetry_breaking = request.get('symmetry_breaking', True)
+        model, classes = entry.assignment_model(symmetry_breaking)
+        solver = schedule.solve_model(model, settings)
+        scheduled_classes = schedule.get_semester_schedule(solver, classes, entry.professors, entry.sections,
+                                                           entry.semesters)
+        job.emit('assignment', requests_met=solver.ObjectiveValue())
+        # the timetables depend on every solver setting, not only on the model options
+        options = (request.get('conflict_encoding', 'occupancy'), request.get('engine', 'exact'),
+                   request.get('compress', True), symmetry_breaking, tuple(sorted(vars(settings).items())))
+        timetables = {}
+        for semester in entry.semesters:
+            key = (semester, tuple(scheduled_classes[semester]), options)
+            if key not in entry.timetables:
+                entry.timetables[key] = schedule.solve_timetables(
+                    scheduled_classes, [semester], entry.professors, entry.sections, entry.times,
+                    request.get('conflict_encoding', 'occupancy'), 1, entry.conflict_index, settings=settings,
+                    symmetry_breaking=symmetry_breaking, engine=request.get('engine', 'exact'),
+                    compress=request.get('compress', True))[semester]
+            timetables[semester] = entry.timetables[key]
+            job.emit('timetable', semester=semester)
+        return scheduled_classes, timetables
+
+    # solve again starting from the last schedule of the source, with minimal_change (default true)
+    # the schedule moves as little as possible
+    def resolve(self, job, request):
+        source = request.get('source', schedule.EXCEL_NAME)
+        if source not in self.last_schedules:
+            return self.solve(job, request)
+        entry = self.load(job, request)
+        previous, previous_slots = schedule.match_schedule(self.last_schedules[source], entry.professors,
+                                                           entry.sections, entry.times)
+        return self.solve(job, request, previous, previous_slots, request.get('minimal_change', True))
+
+    # request: source, scenarios (see schedule.apply_scenario), processes and the solver options
+    def scenarios(self, job, request):
+        entry = self.load(job, request)
+        rows = schedule.run_scenarios(request.get('scenarios', []), entry.professors, entry.sections,
+                                      entry.semesters, entry.times, request.get('conflict_encoding', 'occupancy'),
+                                      request.get('processes', 1), entry.conflict_index, self.settings(request),
+                                      request.get('symmetry_breaking', True))
+        results = []
+        for name, metrics, seconds in rows:
+            row = {'scenario': name, 'seconds': seconds, 'feasible': metrics is not None}
+            if metrics is not None:
+                row.update(requests_met=metrics[0], preferred_times=metrics[1], conflicts=metrics[2],
+                           classes=metrics[3], score=schedule.schedule_score(*metrics))
+            results.append(row)
+            job.emit('scenario', **row)
+        return {'scenarios': results}
+
+
+# json api of the service:
+#   POST /solve, /resolve, /scenarios   run a request, the body is its json options
+#       with "stream": true the events are sent as json lines while it runs,
+#       with "wait": false only the job id is returned
+#   POST /jobs/<id>/cancel              stop a running job
+#   GET /jobs, /jobs/<id>               job status and result
+#   GET /jobs/<id>/events               stream the events of a job
+#   GET /health
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, job):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        for event in job.stream():
+            self.wfile.write(json.dumps(event).encode() + b'\n')
+            self.wfile.flush()
+
+    def find_job(self, parts):
+        try:
+            return self.service.jobs[int(parts[1])]
+        except (IndexError, ValueError, KeyError):
+            self.send_json({'error': 'unknown job'}, 404)
+            return None
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['health']:
+            self.send_json({'status': 'ok', 'cached_inputs': len(self.service.inputs.entries)})
+        elif parts == ['jobs']:
+            self.send_json([job.summary() for job in list(self.service.jobs.values())])
+        elif parts[0] == 'jobs' and len(parts) in (2, 3):
+            job = self.find_job(parts)
+            if job is None:
+                return
+            if len(parts) == 3 and parts[2] == 'events':
+                self.send_stream(job)
+            else:
+                self.send_json(job.summary())
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_json({'error': 'invalid json'}, 400)
+            return
+        if parts[0] == 'jobs' and len(parts) == 3 and parts[2] == 'cancel':
+            job = self.find_job(parts)
+            if job is not None:
+                job.cancel()
+                self.send_json(job.summary())
+        elif len(parts) == 1 and parts[0] in ('solve', 'resolve', 'scenarios'):
+            try:
+                job = self.service.submit(parts[0], request)
+            except ValueError as error:
+                self.send_json({'error': str(error)}, 400)
+                return
+            if request.get('stream'):
+                self.send_stream(job)
+            elif not request.get('wait', True):
+                self.send_json(job.summary(), 202)
+            else:
+                for _ in job.stream():
+                    pass
+                self.send_json(job.summary())
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    # unix sockets have no client address, the request handler logs one
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+# serve on a local port, or on a unix socket if one is given
+def serve(port=DEFAULT_PORT, socket_path=None, max_inputs=MAX_CACHED_INPUTS):
+    ServiceHandler.service = SchedulingService(max_inputs)
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, ServiceHandler)
+        print('Serving on unix socket', socket_path)
+    else:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', port), ServiceHandler)
+        print('Serving on http://127.0.0.1:%i' % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep course schedule inputs and models in memory and serve '
+                                                 'solve requests.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='local http port (default: %(default)s)')
+    parser.add_argument('--socket', help='serve on this unix socket instead of a port')
+    parser.add_argument('--max-inputs', type=int, default=MAX_CACHED_INPUTS,
+                        help='number of parsed inputs kept in memory')
+    args = parser.parse_args()
+    serve(args.port, args.socket, args.max_inputs)